@@ -1,43 +1,499 @@
+import re
+import sys
+import json
+import mmap
+import os
+import struct
+import threading
+
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from enum import IntEnum
-from collections import deque
+from functools import wraps
+from fnmatch import fnmatchcase
+from heapq import nlargest, nsmallest
+from itertools import chain, compress, count, islice, repeat
+from operator import eq, ge, gt, is_, le, lt, ne
 
 const = IntEnum('Constants', 'END START', start=-1)
+kind = IntEnum('Kind', 'LEAF NODE TREE', start=0)
+tag = IntEnum('Tag', 'NONE INT FLOAT STR BOOL JSON', start=0)
+
+
+# Lookup maps keep a single item per key and switch to an {id(item): item}
+# dict when a key is shared, so the common case costs no more than a plain
+# dict entry and shared keys still add and remove in constant time.
+def _multi_add(mapping, key, item):
+    found = mapping.get(key)
+    if found is None:
+        mapping[key] = item
+    elif isinstance(found, dict):
+        found[id(item)] = item
+    elif found is not item:
+        mapping[key] = {id(found): found, id(item): item}
+
+
+def _multi_remove(mapping, key, item):
+    found = mapping.get(key)
+    if found is item:
+        del mapping[key]
+    elif isinstance(found, dict):
+        found.pop(id(item), None)
+        if len(found) == 1:
+            mapping[key] = next(iter(found.values()))
+
+
+def _multi_first(found):
+    return next(iter(found.values())) if isinstance(found, dict) else found
+
+
+def _multi_items(found):
+    if found is None:
+        return []
+    return list(found.values()) if isinstance(found, dict) else [found]
+
+
+# A diff() path step is the name with '/' and backslashes escaped by a
+# backslash, followed by [k] for the k-th sibling of that name and for
+# names that would read as one.
+_ORDINAL = re.compile(r'(.*)\[(\d+)\]\Z', re.S)
+
+
+def _step(path, name, k):
+    if isinstance(name, str):
+        step = name.replace('\\', '\\\\').replace('/', '\\/')
+        step = f'{step}[{k}]' if k or _ORDINAL.match(name) else step
+    else:
+        step = f'{name}[{k}]' if k else name
+    return f'{path}/{step}' if path else step
+
+
+def _steps(path):
+    # Splits a diff() path at the slashes _step() left unescaped.
+    steps, step = [], []
+    chars = iter(path)
+    for char in chars:
+        if char == '\\':
+            step.append(next(chars, ''))
+        elif char == '/':
+            steps.append(''.join(step))
+            step = []
+        else:
+            step.append(char)
+    steps.append(''.join(step))
+    return steps
+
+
+def _ordinals(names):
+    counts, ordinals = {}, []
+    for name in names:
+        if name is None:
+            ordinals.append(None)
+            continue
+        k = counts.get(name, 0)
+        counts[name] = k + 1
+        ordinals.append(k)
+    return ordinals
+
+
+# Trees made with concurrent=True guard their methods with the root's lock,
+# other trees go straight through.
+def _locked(write):
+    def decorate(method):
+        @wraps(method)
+        def locked(self, *args, **kwargs):
+            if not RWLock.instances:
+                return method(self, *args, **kwargs)
+
+            root = self.root
+            lock = root.lock if root is not None else None
+            if lock is None:
+                return method(self, *args, **kwargs)
+
+            with lock.writing() if write else lock.reading():
+                return method(self, *args, **kwargs)
+        return locked
+    return decorate
+
+
+_reads = _locked(False)
+_writes = _locked(True)
+
+
+def _log(item, op, old=None, new=None):
+    if not Journal.instances:
+        return
+
+    root = item.root
+    journal = root.journal if root is not None else None
+    if journal is not None:
+        journal.record(op, item, old, new)
+
+
+class RWLock:
+    # Any number of readers or one writer. A waiting writer holds off new
+    # readers, so a steady stream of lookups cannot starve it, and a writer
+    # done lets the readers that queued up in first. Both sides are
+    # reentrant and the writer may read, a reader may not start writing.
+    instances = 0
+
+    def __init__(self):
+        RWLock.instances += 1
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+        self._queued = 0
+        self._handoff = False
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+
+            self._queued += 1
+            while self._writer is not None or self._waiting and not self._handoff:
+                self._cond.wait()
+            self._queued -= 1
+            if not self._queued:
+                self._handoff = False
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+            elif me in self._readers:
+                message = 'cannot write to a tree while reading it.'
+                raise RuntimeError(message)
+
+            self._waiting += 1
+            while self._writer is not None or self._readers or self._handoff:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._handoff = self._queued > 0
+                self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+Change = namedtuple('Change', 'version op id path old new')
+Edit = namedtuple('Edit', 'op path old new')
+
+
+class Journal:
+    # Changes made to a tree, numbered by a version that only goes up. An
+    # 'add' stands for the item and whatever is below it at that moment,
+    # 'move' holds the old and new parent paths and 'reindex' asks for the
+    # subtree to be read again. With a size only the latest changes are
+    # kept, asking for older ones is an error the reader recovers from by
+    # reading the whole tree. Subscribers are called by the writer.
+    instances = 0
+
+    def __init__(self, size=None):
+        Journal.instances += 1
+        self.size = size
+        self.version = 0
+        self.changes = []
+        self.subscribers = []
+
+    def record(self, op, item, old=None, new=None):
+        self.version += 1
+        change = Change(self.version, op, item.id, item.path(), old, new)
+        changes = self.changes
+        changes.append(change)
+        if self.size and len(changes) > 2 * self.size:
+            del changes[:-self.size]
+
+        for callback in self.subscribers:
+            callback(change)
+        return change
+
+    def since(self, version):
+        changes = self.changes
+        first = changes[0].version if changes else self.version + 1
+        if version < first - 1:
+            message = f'changes before version {first} are no longer kept.'
+            raise ValueError(message)
+        return changes[max(version - first + 1, 0):]
+
+
+class ColumnStore:
+    # Column values of a columnar DTree, one typed array per data column
+    # indexed by item id with a mask of the rows that hold a value. Columns
+    # without a typecode keep their values in a plain list.
+    def __init__(self, types):
+        self.types = tuple(types)
+        self.data = [array(t) if t else [] for t in self.types]
+        self.mask = bytearray()
+        self.size = 0
+
+    @property
+    def width(self):
+        return len(self.types)
+
+    def _grow(self, size):
+        need = size - self.size
+        if need > 0:
+            need = max(need, self.size)
+            for column, typecode in zip(self.data, self.types):
+                column.extend(repeat(0 if typecode else None, need))
+            self.mask.extend(bytes(need * self.width))
+            self.size += need
+
+    def row(self, _id):
+        offset = _id * self.width
+        mask = self.mask[offset:offset + self.width]
+        return tuple(column[_id] if present else None for column, present in zip(self.data, mask))
+
+    def fits(self, values):
+        # Whether values can be stored without a column's typecode refusing
+        # one, checked before anything is written.
+        if len(values) > self.width:
+            return False
+        for typecode, value in zip(self.types, values):
+            if typecode and value is not None:
+                try:
+                    array(typecode, (value, ))
+                except (TypeError, OverflowError):
+                    return False
+        return True
+
+    def set_row(self, _id, values):
+        if len(values) > self.width:
+            message = f'{len(values)} columns given, the tree stores {self.width}.'
+            raise ValueError(message)
+        elif not self.fits(values):
+            message = f'{tuple(values)} do not fit the column types {self.types}.'
+            raise ValueError(message)
+
+        self._grow(_id + 1)
+        values = tuple(values) + (None, ) * (self.width - len(values))
+        for column, value in enumerate(values):
+            self.set_value(_id, column, value)
+
+    def set_value(self, _id, column, value):
+        offset = _id * self.width + column
+        typecode = self.types[column]
+        if typecode and value is not None and not self.fits((None, ) * column + (value, )):
+            message = f'{value!r} does not fit the column type {typecode}.'
+            raise ValueError(message)
+
+        if value is None:
+            self.mask[offset] = 0
+            self.data[column][_id] = 0 if self.types[column] else None
+        else:
+            self.data[column][_id] = value
+            self.mask[offset] = 1
+
+    def clear(self, _id):
+        if _id < self.size:
+            for column in range(self.width):
+                self.set_value(_id, column, None)
+
+    def values(self, column, ids):
+        data, mask, width = self.data[column], self.mask, self.width
+        for _id in ids:
+            if _id < self.size and mask[_id * width + column]:
+                yield data[_id]
+
+    def span(self, column, start, stop):
+        stop = min(stop, self.size)
+        return compress(self.data[column][start:stop], self.mask[start * self.width + column:stop * self.width:self.width])
+
+
+class NameGrams:
+    # Trigrams of the names in a tree, so that the names holding part of a
+    # query are found without testing every one. Names that go away are
+    # left in, whatever is found is checked against the tree's names.
+    def __init__(self, names):
+        self.names = set()
+        self.grams = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if not isinstance(name, str) or name in self.names:
+            return
+
+        self.names.add(name)
+        for gram in {name[i:i + 3] for i in range(max(len(name) - 2, 1))}:
+            self.grams.setdefault(gram, set()).add(name)
+
+    def find(self, part):
+        # Names that may contain part. A shorter part lies within a trigram
+        # or is a short name of its own.
+        if len(part) < 3:
+            found = set()
+            for gram, names in self.grams.items():
+                if part in gram:
+                    found |= names
+            return found
+
+        grams = sorted((self.grams.get(part[i:i + 3], ()) for i in range(len(part) - 2)), key=len)
+        return grams[0].intersection(*grams[1:]) if grams[0] else set()
 
 
 class Base:
+    # Items are created by the hundred thousand, so Leaf and Node keep their
+    # state in slots and the columns in a tuple that set() replaces. Node
+    # holds its children in a list, a deque allocates a 64 slot block even
+    # for the two or three children most nodes have.
+    __slots__ = ()
+    type = None
+
     def __init__(self, data=None, **kwargs):
-        self.type = None
         if data:
             self.id = data.get('id')
-            self.name = data.get('name')
+            self._name = data.get('name')
             self.parent = data.get('parent')
-            self.columns = data.get('columns', [])
+            self._columns = tuple(data.get('columns', ()))
         else:
             self.id = kwargs.get('id')
-            self.name = kwargs.get('name')
+            self._name = kwargs.get('name')
             self.parent = kwargs.get('parent')
-            self.columns = kwargs.get('columns', [])
+            self._columns = tuple(kwargs.get('columns', ()))
+
+        self._path = None
+        self._tree = None
+        self._span = None
+
+    @property
+    def columns(self):
+        columns = self._columns
+        return columns if type(columns) is tuple else columns.row(self.id)
+
+    @columns.setter
+    @_writes
+    def columns(self, values):
+        old = self.columns
+        columns = self._columns
+        if type(columns) is tuple:
+            self._columns = tuple(values)
+        else:
+            columns.set_row(self.id, values)
+        _log(self, 'set', old, self.columns)
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    @_writes
+    def name(self, value):
+        old = self._name
+        parent = self.parent
+        if parent is None:
+            self._name = value
+            self._forget()
+            _log(self, 'rename', old, value)
+            return
+
+        root = self.root
+        if root is not None:
+            _multi_remove(root._named, self._name, self)
+
+        parent._names_remove(self)
+        self._name = value
+        parent._names_add(self)
+        self._forget()
+
+        if root is not None:
+            _multi_add(root._named, value, self)
+            if root._grams is not None:
+                root._grams.add(value)
+        _log(self, 'rename', old, value)
 
     @property
     def tree(self):
+        tree = self._tree
+        if tree is not None:
+            return tree
+
+        items = []
         item = self
-        while not isinstance(item, DTree):
+        while item is not None and item._tree is None:
+            items.append(item)
             item = item.parent
-            if not item:
-                break
-        return item
+
+        tree = item._tree if item is not None else None
+        if tree is not None:
+            for item in items:
+                item._tree = tree
+        return tree
+
+    @property
+    def root(self):
+        item = self
+        while item.parent is not None:
+            item = item.parent
+        return item if isinstance(item, DTree) else None
+
+    @property
+    def span(self):
+        # Nested set numbers, see DTree.number().
+        span = self._span
+        return span[:2] if span is not None else None
 
     def clone(self, dst):
+        # The copy is built in one pass and shares the column tuples, which
+        # set() replaces rather than changes, until either side writes.
         if isinstance(self, Node):
             node = Node(name=self.name)
             items = [node]
             results = []
             if isinstance(dst, Node):
                 dst.append(node)
-                results = node.populate(self.to_list())
+                results = node.populate(self._entries(), bulk=True) or []
 
             return items + results
 
+    def _entry(self):
+        entry = {'name': self.name, 'columns': self.columns}
+        if isinstance(self, Node):
+            entry['children'] = self._entries()
+        return entry
+
     def get(self, columns=None):
         if not columns:
             columns = (0, )
@@ -47,16 +503,18 @@ class Base:
             return
 
         data = []
+        values = self.columns
         for column in columns:
-            if column < 0 or column > len(self.columns):
+            if column < 0 or column > len(values):
                 continue
             elif not column:
                 data.append(self.name)
-            elif 0 < column < len(self.columns)+1:
-                data.append(self.columns[column-1])
+            elif 0 < column < len(values)+1:
+                data.append(values[column-1])
 
         return data[0] if len(data) == 1 else tuple(data) if data else None
 
+    @_writes
     def set(self, columns, values):
         if not isinstance(columns, tuple) or not isinstance(values, tuple):
             values = (values, )
@@ -66,26 +524,118 @@ class Base:
         elif not isinstance(columns, tuple):
             return
 
+        data = None
+        name = rename = None
+        width = len(self.columns)
         for column, value in dict(zip(columns, values)).items():
-            if column < 0 or column > len(self.columns):
+            if column < 0 or column > width:
                 continue
             elif not column:
-                self.name = value
+                name, rename = value, True
             else:
-                self.columns[column-1] = value
+                if data is None:
+                    data = list(self.columns)
+                data[column-1] = value
+
+        # A value the column store refuses leaves the item as it was.
+        store = self._columns
+        if data is not None and type(store) is not tuple and not store.fits(data):
+            message = f'{self.path()} has a value its column type cannot hold.'
+            raise ValueError(message)
+
+        if rename:
+            self.name = name
+        if data is not None:
+            self.columns = tuple(data)
 
     def path(self):
-        uri = []
+        if self._path is not None:
+            return self._path
+
+        items = []
         item = self
-        while item is not None:
-            uri.append(item.name)
+        while item is not None and item._path is None:
+            items.append(item)
             item = item.parent
-        return '/'.join(list(reversed(uri))).lstrip('.')
 
+        # Only the leading dots of the top item are stripped, so a path is
+        # always its parent's path, a slash and its own name.
+        uri = item._path if item is not None else None
+        for item in reversed(items):
+            uri = item.name.lstrip('.') if uri is None else f'{uri}/{item.name}'
+            item._path = uri
+        return uri
+
+    def _forget(self, trees=False):
+        # Drops cached paths, and with trees cached trees, of this item and
+        # below. Caches are filled from the top down, so the walk can stop
+        # at the first item that has nothing cached.
+        stack = [(self, trees)]
+        while stack:
+            item, trees = stack.pop()
+            trees = trees and not isinstance(item, DTree)
+            if item._path is None and not (trees and item._tree is not None):
+                continue
+
+            item._path = None
+            if trees:
+                item._tree = None
+            if isinstance(item, Node):
+                stack.extend((child, trees) for child in item)
+
+    @_writes
     def delete(self, item=None):
-        node = item if item else self
+        node = item if item is not None else self
         parent = node.parent
-        del parent[parent.index(node)]
+        del parent[parent.index_of(node)]
+        node._detach()
+
+    def _detach(self):
+        # Drops an item that is no longer in its parent's list from the
+        # indexes and the column store.
+        _log(self, 'delete', self.columns)
+        parent = self.parent
+        root = self.root
+        if root is not None:
+            root._unregister(self)
+        parent._names_remove(self)
+
+        tree = parent.tree
+        if tree is not None and tree.store is not None:
+            tree._store_detach(self)
+
+        self.parent = None
+        self._forget(trees=True)
+
+    def is_under(self, node):
+        span, top = self._span, node._span
+        if span is not None and top is not None and span[2] is top[2]:
+            return top[0] < span[0] < top[1]
+
+        item = self.parent
+        while item is not None:
+            if item is node:
+                return True
+            item = item.parent
+        return False
+
+    def position(self, top=None):
+        key = []
+        item = self
+        while item.parent is not None and item is not top:
+            parent = item.parent
+            key.append(parent.index_of(item))
+            item = parent
+        return tuple(reversed(key))
+
+    def search_key(self, top=None):
+        # Node.find checks the direct children of a node before descending
+        # into them, this key sorts items the same way.
+        key = ()
+        position = self.position(top)
+        for idx in position[:-1]:
+            key += (1, idx)
+        return key + (0, position[-1]) if position else key
 
     def is_node(self, item=None):
         if item is None:
@@ -94,9 +644,11 @@ class Base:
 
 
 class Leaf(Base):
+    __slots__ = ('id', '_name', 'parent', '_columns', '_path', '_tree', '_span')
+    type = 'Leaf'
+
     def __init__(self, data=None,  **kwargs):
         super().__init__(data, **kwargs)
-        self.type = 'Leaf'
         if self.parent is not None:
             self.parent.append(self)
 
@@ -104,11 +656,14 @@ class Leaf(Base):
         return None
 
 
-class Node(Base, deque):
+class Node(Base, list):
+    __slots__ = ('id', '_name', 'parent', '_columns', '_path', '_tree', '_span', '_names')
+    type = 'Node'
+
     def __init__(self, data=None, **kwargs):
         Base.__init__(self, data, **kwargs)
-        deque.__init__(self)
-        self.type = 'Node'
+        list.__init__(self)
+        self._names = None
         if self.parent is not None:
             self.parent.append(self)
 
@@ -116,124 +671,540 @@ class Node(Base, deque):
     def children(self):
         return self
 
-    def move(self, dst):
-        if isinstance(dst, Node):
-            node = Node(name=self.name)
-            items = [node]
-            dst.append(node)
-            items += node.populate(self.to_list())
-            self.delete()
-            return items
-
-    def show(self, **kwargs):
-        indent = kwargs.get('indent', 2)
-        parent = kwargs.get('parent', self)
-        show_id = kwargs.get('show_id', False)
-        show_columns = kwargs.get('show_columns', True)
+    def child(self, name):
+        names = self._names
+        if names is None:
+            # Small nodes are cheaper to scan than to hash.
+            if len(self) < 8:
+                for item in self:
+                    if item.name == name:
+                        return item
+                return
+            names = self._build_names()
+
+        return _multi_first(names.get(name))
+
+    def index_of(self, item):
+        # Children compare by content, so they are found by identity. The
+        # last child is checked first, the scan otherwise runs in C.
+        if len(self) and self[-1] is item:
+            return len(self) - 1
+
+        idx = next(compress(count(), map(is_, self, repeat(item))), None)
+        if idx is None:
+            message = f'{item.name} is not a child of {self.path()}.'
+            raise ValueError(message)
+        return idx
+
+    @_writes
+    def delete_many(self, items):
+        # Deletes children of this node with one pass over the child list.
+        items = list({id(item): item for item in items}.values())
+        for item in items:
+            if item.parent is not self:
+                message = f'{item.name} is not a child of {self.path()}.'
+                raise ValueError(message)
+
+        drop = {id(item) for item in items}
+        self[:] = [child for child in self if id(child) not in drop]
+        for item in items:
+            item._detach()
+        return len(items)
+
+    def _build_names(self):
+        # Readers share the lock, so the map is only published once it is
+        # complete.
+        names = {}
+        for item in self:
+            _multi_add(names, item.name, item)
+        self._names = names
+        return names
 
-        def walk(_parent, level=0):
-            if not _parent.is_node():
-                return _parent
+    def _names_add(self, item, last=False):
+        names = self._names
+        if names is None:
+            return
 
-            for idx, _node in enumerate(_parent):
-                pad = '' if not level else '─' * (indent * level)
-                for i, c in enumerate(_node.columns):
-                    if c is None:
-                        _node.columns[i] = ''
+        if last or item.name not in names:
+            _multi_add(names, item.name, item)
+        else:
+            names[item.name] = {id(child): child for child in self if child.name == item.name}
+
+    def _names_remove(self, item):
+        if self._names is not None:
+            _multi_remove(self._names, item.name, item)
+
+    @_reads
+    def resolve(self, path):
+        item = self.tree if path.startswith('/') else self
+        for name in path.strip('/').split('/'):
+            if not isinstance(item, Node):
+                return
+            item = item.child(name)
+            if item is None:
+                return
+        return item
 
-                columns = str(_node.columns[0]) if len(_node.columns) == 1 else str(_node.columns)
-                columns = '' if not _node.columns or not show_columns else f': {columns}'
+    @_writes
+    def move(self, dst):
+        # Re-parents this node in place. Inside one tree the items keep their
+        # ids and index entries, moved to another tree they are numbered from
+        # that tree's counter.
+        if not isinstance(dst, Node):
+            return
+        elif dst is self or dst.is_under(self):
+            message = f'cannot move {self.path()} below itself.'
+            raise ValueError(message)
+
+        tree = dst.tree
+        if tree.unique and tree.errors != 'ignore' and dst.child(self.name) is not None:
+            message = f'duplicate name {dst.path()}/{self.name} found.'
+            raise ValueError(message)
+
+        parent = self.parent
+        if parent is None or parent.tree is not tree:
+            if tree.store is not None:
+                tree._check_store(self)
+
+            if parent is not None:
+                self.delete()
+            if tree.store is None and not isinstance(self, DTree):
+                for item in self.members():
+                    item.id = tree.next_id()
+            dst.append(self)
+            return self
+
+        del parent[parent.index_of(self)]
+        parent._names_remove(self)
+
+        list.append(dst, self)
+        dst._names_add(self, last=True)
+        self.parent = dst
+        self._forget()
+        if tree.store is not None:
+            tree._ordered = False
+
+        root = tree.root
+        if root is not None and root._gap:
+            root._place(self)
+        _log(self, 'move', parent.path(), dst.path())
+        return self
 
-                end = '>' if _node.type == 'Node' else '─'
-                node_id = f' {_node.id},' if show_id else ''
-                print(f' ├{pad}{end}{node_id} {_node.name}{columns}')
-                if _parent.is_node(_node):
-                    walk(_node, level+1)
+    def show(self, **kwargs):
+        parent = kwargs.get('parent', self)
 
         print('-----------------------------------------------------')
         print(f'Name: {self.name}, Zones: ')
         print('-----------------------------------------------------')
-        walk(parent)
-
+        if not parent.is_node():
+            return self
+
+        return self.render(**dict(kwargs, parent=parent))
+
+    @_reads
+    def render(self, stream=None, **kwargs):
+        # Writes the items below parent a line each, joining a batch of lines
+        # per write. max_children cuts each child list short with a line
+        # counting the rest, offset and limit page through the lines.
+        stream = sys.stdout if stream is None else stream
+        batch = kwargs.get('batch', 1000)
+        offset = kwargs.get('offset', 0)
+        limit = kwargs.get('limit')
+
+        buffer = []
+        lines = self._render_lines(**kwargs)
+        for line in islice(lines, offset, None if limit is None else offset + limit):
+            buffer.append(line)
+            if len(buffer) >= batch:
+                stream.write(''.join(buffer))
+                buffer.clear()
+        stream.write(''.join(buffer))
         return self
 
+    def _render_lines(self, **kwargs):
+        parent = kwargs.get('parent', self)
+        indent = kwargs.get('indent', 2)
+        show_id = kwargs.get('show_id', False)
+        show_columns = kwargs.get('show_columns', True)
+        max_depth = kwargs.get('max_depth')
+        max_children = kwargs.get('max_children')
+
+        stack = [(1, parent, enumerate(parent))]
+        while stack:
+            level, node, children = stack[-1]
+            pad = '─' * (indent * (level - 1))
+            for idx, item in children:
+                if max_children is not None and idx == max_children:
+                    yield f' ├{pad}─ ... {len(node) - idx} more\n'
+                    stack.pop()
+                    break
+
+                data = ['' if c is None else c for c in item.columns]
+                columns = str(data[0]) if len(data) == 1 else str(data)
+                columns = '' if not data or not show_columns else f': {columns}'
+
+                end = '>' if item.type == 'Node' else '─'
+                node_id = f' {item.id},' if show_id else ''
+                yield f' ├{pad}{end}{node_id} {item.name}{columns}\n'
+
+                if isinstance(item, Node) and (max_depth is None or level < max_depth):
+                    stack.append((level + 1, item, enumerate(item)))
+                    break
+            else:
+                stack.pop()
+
+    @_reads
     def query(self, query):
         if isinstance(query, int):
             item = self.find_by_id(query)
         elif isinstance(query, str):
             item = self.find(query)
+        elif isinstance(query, Query):
+            item = query.run(self)
         else:
             item = None
 
         return item
 
+    def select(self, path='*', **kwargs):
+        return Query(path, **kwargs).run(self)
+
+    @_writes
     def append(self, item, parent=None) -> str:
         parent = parent if parent else self
 
         new_item = ''
-        if self.tree.unique:
-            for child in parent:
-                if child.name == item.name and self.tree.errors != 'ignore':
-                    message = f'duplicate name {item.path()} found.'
-                    raise ValueError(message)
+        tree = self.tree
+        if tree.unique and tree.errors != 'ignore' and parent.child(item.name) is not None:
+            message = f'duplicate name {item.path()} found.'
+            raise ValueError(message)
+
+        if tree.store is not None:
+            tree._check_store(item)
 
         if isinstance(item, Leaf) or isinstance(item, Node):
             super(Node, self).append(item)
+            self._names_add(item, last=True)
 
             new_item = parent[len(parent)-1]
             if new_item.parent is None:
                 new_item.parent = parent
+            item._forget(trees=True)
 
-            item.id = self.tree.next_id()
-            item.columns += [None] * (len(self.tree.data_columns) - len(item.columns))
+            item.id = tree.next_id()
+            item._columns = item.columns + (None, ) * (len(tree.data_columns) - len(item.columns))
+            if tree.store is not None:
+                tree._store_attach(item, parent)
+
+            root = tree.root
+            if root is not None:
+                root._register(item)
+            _log(item, 'add', None, item.columns)
 
         return new_item
 
+    @_writes
     def insert(self, idx, item, parent=None):
         parent = parent if parent else self
 
-        if self.tree.unique:
-            for child in parent:
-                if child.name == item.name and self.tree.errors != 'ignore':
-                    message = f'duplicate name {item.path()} found.'
-                    raise ValueError(message)
+        tree = self.tree
+        if tree.unique and tree.errors != 'ignore' and parent.child(item.name) is not None:
+            message = f'duplicate name {item.path()} found.'
+            raise ValueError(message)
 
         if idx == int(const.END):
             idx = len(parent)
         elif idx < int(const.START):
             idx = int(const.START)
 
+        if tree.store is not None:
+            tree._check_store(item)
+
         if isinstance(item, Leaf) or isinstance(item, Node):
             super(Node, self).insert(idx, item)
+            self._names_add(item)
 
             if item.parent is None:
                 item.parent = parent
-
-            item.id = self.tree.next_id()
-            item.columns += [None] * (len(self.tree.data_columns) - len(item.columns))
+            item._forget(trees=True)
+
+            item.id = tree.next_id()
+            item._columns = item.columns + (None, ) * (len(tree.data_columns) - len(item.columns))
+            if tree.store is not None:
+                tree._ordered = False
+                tree._store_attach(item, parent)
+
+            root = tree.root
+            if root is not None:
+                root._register(item)
+            _log(item, 'add', None, item.columns)
         return item
 
+    @_reads
     def to_list(self, parent=None):
-        def set_data(_item, _data):
-            for node in _item:
-                _item_data = {'name': node.name, 'columns': node.columns}
-                _data.append(_item_data)
-                if node.is_node():
-                    _item_data['children'] = []
-                    set_data(node, _item_data['children'])
-
         data = []
+        stack = [data]
         parent = parent if parent else self
-        for item in parent:
+        for level, item in parent.walk(levels=True):
+            del stack[level:]
             if item.is_node():
-                item_data = {'name': item.name, 'columns': item.columns, 'children': []}
-                data.append(item_data)
-                set_data(item, item_data['children'])
+                item_data = {'name': item.name, 'columns': list(item.columns), 'children': []}
+                stack[-1].append(item_data)
+                stack.append(item_data['children'])
             else:
-                item_data = {'name': item.name, 'columns': item.columns}
-                data.append(item_data)
+                item_data = {'name': item.name, 'columns': list(item.columns)}
+                stack[-1].append(item_data)
         return data
 
+    def _entries(self):
+        # Like to_list() but keeps the column tuples for populate() to share.
+        data = []
+        stack = [data]
+        for level, item in self.walk(levels=True):
+            del stack[level:]
+            entry = {'name': item.name, 'columns': item.columns}
+            stack[-1].append(entry)
+            if item.is_node():
+                entry['children'] = []
+                stack.append(entry['children'])
+        return data
+
+    @_reads
+    def diff(self, other):
+        # Edits that turn this subtree into other, keyed by paths relative
+        # to this node. Children are matched by name, subtrees with the same
+        # hash are skipped and a subtree that only changed its name is a
+        # rename. The order of siblings is not compared. A path step name[k]
+        # is the k-th sibling called name when the edit is played, so that
+        # siblings sharing a name are told apart.
+        mine, theirs = self._digests(), other._digests()
+        edits = []
+        if self.columns != other.columns:
+            edits.append(Edit('set', '', self.columns, other.columns))
+
+        stack = [(self, other, '')]
+        while stack:
+            old, new, path = stack.pop()
+            # Unchanged children are matched first, so that siblings
+            # sharing a name are only paired up with the ones that changed.
+            unchanged = {}
+            for child in old:
+                unchanged.setdefault(mine[id(child)][1], deque()).append(child)
+            changed, matched = [], set()
+            for child in new:
+                same = unchanged.get(theirs[id(child)][1])
+                if same:
+                    matched.add(id(same.popleft()))
+                else:
+                    changed.append(child)
+
+            olds = {}
+            for child in old:
+                if id(child) not in matched:
+                    olds.setdefault(child.name, deque()).append(child)
+
+            pairs, added, deleted = [], [], []
+            for child in changed:
+                same = olds.get(child.name)
+                if not same:
+                    added.append(child)
+                    continue
+
+                item = same.popleft()
+                if isinstance(item, Node) != isinstance(child, Node):
+                    deleted.append(item)
+                    added.append(child)
+                else:
+                    pairs.append((item, child))
+
+            renamed = {}
+            for same in olds.values():
+                for child in same:
+                    renamed.setdefault(mine[id(child)][0], deque()).append(child)
+            renames, kept = [], []
+            for child in added:
+                same = renamed.get(theirs[id(child)][0])
+                if same:
+                    renames.append((same.popleft(), child.name))
+                else:
+                    kept.append(child)
+            for same in renamed.values():
+                deleted.extend(same)
+
+            # Renames and deletes go from the last sibling back, each one
+            # only shifts the ordinals of siblings already edited.
+            names = [child.name for child in old]
+            position = {id(child): i for i, child in enumerate(old)}
+            ordinals = _ordinals(names)
+            for item, name in sorted(renames, key=lambda rename: position[id(rename[0])], reverse=True):
+                at = position[id(item)]
+                edits.append(Edit('rename', _step(path, item.name, ordinals[at]), item.name, name))
+                names[at] = name
+
+            ordinals = _ordinals(names)
+            for item in sorted(deleted, key=lambda item: position[id(item)], reverse=True):
+                at = position[id(item)]
+                edits.append(Edit('delete', _step(path, names[at], ordinals[at]), item._entry(), None))
+                names[at] = None
+
+            ordinals = _ordinals(names)
+            for item, child in pairs:
+                at = _step(path, item.name, ordinals[position[id(item)]])
+                if item.columns != child.columns:
+                    edits.append(Edit('set', at, item.columns, child.columns))
+                if isinstance(item, Node):
+                    stack.append((item, child, at))
+
+            counts = {}
+            for name in names:
+                if name is not None:
+                    counts[name] = counts.get(name, 0) + 1
+            for child in kept:
+                k = counts.get(child.name, 0)
+                counts[child.name] = k + 1
+                edits.append(Edit('add', _step(path, child.name, k), None, child._entry()))
+        return edits
+
+    @_writes
+    def apply(self, edits):
+        # Plays edits made by diff() on this node, in order.
+        for edit in edits:
+            steps = _steps(edit.path) if edit.path else []
+            if edit.op == 'add':
+                parent = self._locate(steps[:-1])
+                item = parent.populate([edit.new], bulk=True) if isinstance(parent, Node) else None
+                if item is None:
+                    message = f'cannot add {edit.path}, its parent is not a node.'
+                    raise ValueError(message)
+                continue
+
+            item = self._locate(steps)
+            if item is None:
+                message = f'{edit.path} not found.'
+                raise ValueError(message)
+            elif edit.op == 'delete':
+                item.delete()
+            elif edit.op == 'rename':
+                item.name = edit.new
+            elif edit.op == 'set':
+                item.columns = edit.new
+            else:
+                message = f'unknown edit {edit.op}.'
+                raise ValueError(message)
+        return len(edits)
+
+    def _locate(self, steps):
+        # Resolves the steps of a diff() path, see _step().
+        item = self
+        for step in steps:
+            if not isinstance(item, Node):
+                return
+            match = _ORDINAL.match(step)
+            item = item._sibling(match[1], int(match[2])) if match else item._sibling(step, 0)
+            if item is None:
+                return
+        return item
+
+    def _sibling(self, name, k):
+        # The k-th child called name in sibling order. child() gives the
+        # first when the name is not shared.
+        found = self.child(name)
+        if found is None:
+            return
+        elif not k and (self._names is None or not isinstance(self._names.get(name), dict)):
+            return found
+        return next(islice((item for item in self if item.name == name), k, None), None)
+
+    def _digests(self):
+        # Hashes of every subtree, bottom up: (without the name, with it).
+        digests = {}
+        for item in chain(self.walk(order='post'), (self, )):
+            columns = item.columns
+            try:
+                content = hash(columns)
+            except TypeError:
+                content = hash(repr(columns))
+            if isinstance(item, Node):
+                content = hash((content, tuple(sorted(digests[id(child)][1] for child in item))))
+            digests[id(item)] = (content, hash((item.name, content)))
+        return digests
+
+    def iter_records(self, parent=None):
+        # Flat rows in pre-order. Ids number the rows of this export, a row
+        # refers to its parent's row and 0 is the exported node itself.
+        parent = parent if parent else self
+        stack = [0]
+        for row, (level, item) in enumerate(parent.walk(levels=True), 1):
+            del stack[level:]
+            yield {'id': row, 'parent': stack[-1], 'type': item.type, 'name': item.name, 'columns': list(item.columns)}
+            if item.is_node():
+                stack.append(row)
+
+    @_reads
+    def export(self, stream, fmt='ndjson', parent=None, batch=1000):
+        # Writes iter_records() as lines of JSON, or the to_list() structure
+        # as one JSON document, a batch of items at a time.
+        parent = parent if parent else self
+        if fmt == 'ndjson':
+            chunks = (json.dumps(record) + '\n' for record in parent.iter_records())
+        elif fmt == 'json':
+            chunks = self._json_chunks(parent)
+        else:
+            message = f'unknown export format {fmt}.'
+            raise ValueError(message)
+
+        buffer = []
+        for chunk in chunks:
+            buffer.append(chunk)
+            if len(buffer) >= batch:
+                stream.write(''.join(buffer))
+                buffer.clear()
+        stream.write(''.join(buffer))
+
+    @staticmethod
+    def _json_chunks(parent):
+        yield '['
+        depth = 0
+        first = True
+        for level, item in parent.walk(levels=True):
+            if level <= depth:
+                yield ']}' * (depth - level + 1)
+                depth = level - 1
+                first = False
+            data = {'name': item.name, 'columns': list(item.columns)}
+            chunk = json.dumps(data)
+            if item.is_node():
+                chunk = chunk[:-1] + ', "children": ['
+                depth = level
+            yield chunk if first else ', ' + chunk
+            first = item.is_node()
+        yield ']}' * depth + ']'
+
+    @_writes
+    def populate_records(self, records, parent=None):
+        # Reads rows shaped like iter_records() as they come, only the
+        # nodes on the path to the current row are kept.
+        parent = parent if parent else self
+        stack = [(0, parent)]
+        count = 0
+        for record in records:
+            while stack[-1][0] != record['parent']:
+                stack.pop()
+                if not stack:
+                    message = f'record {record["id"]} does not follow its parent.'
+                    raise ValueError(message)
+
+            if record['type'] == 'Node':
+                item = Node(name=record['name'], columns=record['columns'])
+            else:
+                item = Leaf(name=record['name'], columns=record['columns'])
+            stack[-1][1].append(item)
+            if item.is_node():
+                stack.append((record['id'], item))
+            count += 1
+        return count
+
+    @_writes
     def populate(self, data, **kwargs):
         def walk(parent, item):
             if 'children' in item:
@@ -251,6 +1222,9 @@ class Node(Base, deque):
         if not data:
             return
 
+        if kwargs.get('bulk') and isinstance(data, list):
+            return self._populate_bulk(data, kwargs.get('parent', self))
+
         items = []
         if isinstance(data, list):
             for cfg in data:
@@ -258,6 +1232,124 @@ class Node(Base, deque):
 
         return items
 
+    @_writes
+    def graft(self, source):
+        if isinstance(source, DTree):
+            source = Snapshot.dump(source)
+        if not isinstance(source, Snapshot):
+            source = Snapshot(source)
+        item = source.materialize(self)
+        _log(item, 'add', None, item.columns)
+        return item
+
+    @_writes
+    def populate_sharded(self, shards, loader=None, workers=None):
+        # Every shard is built into a tree of its own in a worker process and
+        # comes back as a snapshot. The grafts run here in shard order while
+        # the pool works on the rest, so the ids match a single populate.
+        tree = self.tree
+        settings = {'unique': tree.unique, 'errors': tree.errors, 'data_columns': tree.data_columns}
+        with ProcessPoolExecutor(workers) as pool:
+            return [self.graft(buffer) for buffer in pool.map(_build_shard, shards, repeat(loader), repeat(settings))]
+
+    def _populate_bulk(self, data, parent):
+        # Builds the items straight into place: the tree is resolved once,
+        # names are checked with a set per sibling list before anything is
+        # added and the new items take one contiguous block of ids.
+        tree = parent.tree
+        root = tree.root
+        store = tree.store
+        width = len(tree.data_columns)
+        self._check_populate(data, parent, tree)
+
+        if store is not None and tree._ordered:
+            last = tree._last
+            tree._ordered = last is parent or last.is_under(parent)
+
+        _id = tree.items
+        items = []
+        top = []
+        item = None
+        stack = [(parent, iter(data))]
+        while stack:
+            node, entries = stack[-1]
+            for entry in entries:
+                _id += 1
+                children = entry.get('children')
+                item = Leaf.__new__(Leaf) if children is None else Node.__new__(Node)
+                item.id = _id
+                item._name = entry.get('name')
+                item.parent = node
+                item._path = None
+                item._tree = tree
+                item._span = None
+
+                columns = tuple(entry.get('columns', ()))
+                if len(columns) < width:
+                    columns += (None, ) * (width - len(columns))
+                if store is not None:
+                    store.set_row(_id, columns)
+                    columns = store
+                item._columns = columns
+
+                list.append(node, item)
+                if node is parent:
+                    parent._names_add(item, last=True)
+                    top.append(item)
+                if root is not None:
+                    root._index_add(item)
+
+                if children is not None:
+                    item._names = None
+                    if children:
+                        stack.append((item, iter(children)))
+                        break
+                items.append(item)
+            else:
+                stack.pop()
+                if node is not parent:
+                    items.append(node)
+
+        tree.items = _id
+        if store is not None and item is not None:
+            tree._last = item
+        if root is not None and root._gap:
+            for item in top:
+                root._place(item)
+        for item in top:
+            _log(item, 'add', None, item.columns)
+        return items
+
+    @staticmethod
+    def _check_populate(data, parent, tree):
+        store = tree.store
+        width = len(tree.data_columns) if store is not None else None
+        unique = tree.unique and tree.errors != 'ignore'
+
+        stack = [(parent.path(), {child.name for child in parent} if unique else None, data)]
+        while stack:
+            path, names, entries = stack.pop()
+            for entry in entries:
+                name = entry.get('name')
+                if unique:
+                    if name in names:
+                        message = f'duplicate name {path}/{name} found.'
+                        raise ValueError(message)
+                    names.add(name)
+
+                if width is not None:
+                    columns = entry.get('columns', ())
+                    if len(columns) > width:
+                        message = f'{path}/{name} has more columns than the tree stores.'
+                        raise ValueError(message)
+                    elif not store.fits(columns):
+                        message = f'{path}/{name} has a value its column type cannot hold.'
+                        raise ValueError(message)
+
+                if entry.get('children'):
+                    stack.append((f'{path}/{name}', set() if unique else None, entry['children']))
+
+    @_reads
     def get_cell(self, row, column):
         item = self.query(row)
         if item is None:
@@ -276,49 +1368,246 @@ class Node(Base, deque):
         else:
             item.name = value
 
+    @_reads
     def find_all(self, query, recursive=False):
-        def find(item):
-            if item.name == query:
-                items.append(item)
+        # Only branches leading to an item named like the query can hold a
+        # match, everything else is skipped without building its path. With
+        # a '/' in the query the children of a child that does not match are
+        # tried as well, and recursion goes on from those.
+        items = [self] if self.name == query else []
+        matches = self._match_candidates(query)
+        branches = set()
+        if matches is None:
+            matches, inside = {}, True
+        elif not matches:
+            return items
+        else:
+            for item in matches.values():
+                item = item.parent
+                while item is not None and id(item) not in branches:
+                    branches.add(id(item))
+                    item = item.parent
 
-            for child in item:
-                if '/' in query and query not in child.path() and child.is_node():
-                    for d in child:
-                        if query in d.path() and d not in items:
-                            items.append(d)
-                        if d.is_node() and recursive:
-                            find(d)
-                elif query in child.path() and child not in items:
-                    items.append(child)
-                elif recursive and child.is_node():
-                    find(child)
+            inside = False
+            item = self
+            while item is not None and not inside:
+                inside = id(item) in matches
+                item = item.parent
+
+        nested = '/' in query
+        inside = [inside]
+        descend = False
+        # walk() calls prune() once the item has been looked at below.
+        walk = self.walk(levels=True, max_depth=None if recursive else 1 + nested, prune=lambda _: not descend)
+        for level, item in walk:
+            here = inside[level - 1] or id(item) in matches
+            inside[level:] = (here, )
+            if not here and id(item) not in branches:
+                descend = False
+                continue
 
-        items = []
-        find(self)
+            found = here and query in item.path()
+            if found:
+                items.append(item)
+            descend = recursive if nested and not level % 2 else not found
         return items
 
+    def _match_candidates(self, query):
+        root = self.root
+        if root is None:
+            return
+
+        # A path containing the query must hold a name that contains its
+        # longest segment: exactly for inner segments, as a suffix for the
+        # first and as a prefix for the last.
+        parts = query.split('/')
+        first, last = parts[0], parts[-1]
+        inner = max(parts[1:-1], key=len, default='')
+        if inner:
+            test = inner.__eq__
+        elif len(parts) == 1 and query:
+            part, test = query, lambda name: query in name
+        elif first and len(first) >= len(last):
+            part, test = first, lambda name: name.endswith(first)
+        elif last:
+            part, test = last, lambda name: name.startswith(last)
+        else:
+            return
+
+        for name in (root.name, root.name.lstrip('.')):
+            if isinstance(name, str) and test(name):
+                return
+
+        if inner:
+            found = root.named(inner)
+        else:
+            grams = root._grams
+            if grams is None:
+                grams = root._grams = NameGrams(root._named)
+            named, found = root._named, []
+            for name in grams.find(part):
+                if test(name):
+                    found += _multi_items(named.get(name))
+
+        return {id(item): item for item in found}
+
+    @_reads
+    def aggregate(self, column, func='sum'):
+        # Covers the items below this node that belong to its tree, nested
+        # trees define their own data columns.
+        tree = self.tree
+        if isinstance(column, str):
+            column = tree.data_columns.index(column) + 1
+
+        store = tree.store
+        if store is not None and tree._ordered:
+            start, stop = (1, tree.items + 1) if self is tree else (self.id + 1, self.last().id + 1)
+            values = store.span(column - 1, start, stop)
+        elif store is not None:
+            values = store.values(column - 1, (item.id for item in self.members()))
+        else:
+            values = (item.columns[column-1] for item in self.members() if len(item.columns) >= column)
+            values = (value for value in values if value is not None)
+
+        if func == 'count':
+            return sum(1 for _ in values)
+        elif func == 'sum':
+            return sum(values)
+        elif func in ('min', 'max'):
+            return (min if func == 'min' else max)(values, default=None)
+
+        message = f'unknown aggregate {func}.'
+        raise ValueError(message)
+
+    def members(self):
+        # Descendants that belong to the same tree as this node.
+        return self.walk(prune=lambda item: isinstance(item, DTree))
+
+    def last(self):
+        item = self
+        while isinstance(item, Node) and len(item) and (item is self or not isinstance(item, DTree)):
+            item = item[-1]
+        return item
+
+    def walk(self, order='pre', **kwargs):
+        # Iterative traversal of the items below this node. Levels count
+        # from 1 for the direct children, max_depth stops descending below
+        # that level and items for which prune() is true are yielded but
+        # their children are not.
+        levels = kwargs.get('levels', False)
+        max_depth = kwargs.get('max_depth')
+        prune = kwargs.get('prune')
+
+        def expand(_item, _level):
+            return isinstance(_item, Node) and (max_depth is None or _level < max_depth) and \
+                not (prune and prune(_item))
+
+        if order == 'pre' and not levels and max_depth is None and prune is None:
+            stack = [iter(self)]
+            while stack:
+                for item in stack[-1]:
+                    yield item
+                    if isinstance(item, Node):
+                        stack.append(iter(item))
+                        break
+                else:
+                    stack.pop()
+        elif order == 'pre':
+            stack = [iter(self)]
+            while stack:
+                level = len(stack)
+                for item in stack[-1]:
+                    yield (level, item) if levels else item
+                    if expand(item, level):
+                        stack.append(iter(item))
+                        break
+                else:
+                    stack.pop()
+        elif order == 'post':
+            stack = [(None, iter(self))]
+            while stack:
+                level = len(stack)
+                node, children = stack[-1]
+                for item in children:
+                    if expand(item, level):
+                        stack.append((item, iter(item)))
+                        break
+                    yield (level, item) if levels else item
+                else:
+                    stack.pop()
+                    if node is not None:
+                        yield (level - 1, node) if levels else node
+        elif order == 'bfs':
+            queue = deque((1, item) for item in self)
+            while queue:
+                level, item = queue.popleft()
+                yield (level, item) if levels else item
+                if expand(item, level):
+                    queue.extend((level + 1, child) for child in item)
+        else:
+            message = f'unknown traversal order {order}.'
+            raise ValueError(message)
+
+    @_reads
     def find_by_id(self, _id):
-        for child in self:
-            if child.id == _id:
-                return child
+        root = self.root
+        if root is None:
+            for item in self.walk():
+                if item.id == _id:
+                    return item
+            return
 
-            if child.is_node() and len(child):
-                result = child.query(_id)
-                if result is not None:
-                    return result
+        found = root._index.get(_id)
+        if found is None:
+            return
+        elif not isinstance(found, dict):
+            return found if self is root or found.is_under(self) else None
+
+        # Nested trees all number from 1, the first of them in pre-order is
+        # the one a walk would find. Only the branches leading to one are
+        # followed down.
+        items = {id(item): item for item in found.values() if self is root or item.is_under(self)}
+        branches = set()
+        for item in items.values():
+            item = item.parent
+            while item is not self and id(item) not in branches:
+                branches.add(id(item))
+                item = item.parent
+
+        node = self
+        while items:
+            for item in node:
+                if id(item) in items:
+                    return item
+                elif id(item) in branches:
+                    node = item
+                    break
+            else:
+                return
 
+    @_reads
     def find(self, query, **kwargs):
         def search(parent, _query):
-            for _child in parent:
-                if _child.name == _query:
-                    return _child
-
-            for _child in parent:
-                if _child.is_node():
-                    result = search(_child, _query)
-                    if result is not None:
-                        return result
-
+            _child = parent.child(_query)
+            if _child is not None:
+                return _child
+
+            # With few items of that name it is cheaper to rank them in the
+            # order the walk below would visit them than to walk the branch.
+            found = root.named(_query) if root is not None else None
+            if found is not None and len(found) <= 64:
+                found = [item for item in found if item.is_under(parent)]
+                return min(found, key=lambda item: item.search_key(parent)) if found else None
+
+            # Each node checks its own children before its first child node
+            # does, which is a pre-order walk over the nodes.
+            for _node in parent.walk():
+                if _node.is_node():
+                    _child = _node.child(_query)
+                    if _child is not None:
+                        return _child
+
+        root = self.root
         _all = kwargs.get('all', False)
 
         if _all:
@@ -326,12 +1615,8 @@ class Node(Base, deque):
 
         if '/' in query:
             if query.startswith('/'):
-                item = None
                 parts = query.lstrip('/').split('/', 1)
-                for child in self.tree:
-                    if child.name == parts[0]:
-                        item = child
-                        break
+                item = self.tree.child(parts[0])
             else:
                 parts = query.split('/', 1)
                 item = search(self, parts.pop(0))
@@ -348,12 +1633,28 @@ class DTree(Node):
     def __init__(self, **kwargs):
         self.id = 0
         self.items = 0
+        self._index = {}
+        self._named = {}
+        self._grams = None
+        self.lock = RWLock() if kwargs.get('concurrent') else None
+        self.journal = None
 
-        self.type = 'Tree'
         self.errors = kwargs.get('errors')
         self.unique = kwargs.get('unique', True)
         self.data_columns = kwargs.get('data_columns', [])
+
+        self.store = None
+        if kwargs.get('columnar'):
+            types = kwargs.get('column_types') or [None] * len(self.data_columns)
+            self.store = ColumnStore(types)
+
+        # Ids of a columnar tree are kept in pre-order while items are only
+        # appended, which lets aggregates read a subtree as one id range.
+        self._ordered = True
+        self._last = self
+        self._gap = None
         super().__init__()
+        self._tree = self
 
         self.name = kwargs.get('name', '.')
         self.parent = kwargs.get('parent')
@@ -363,19 +1664,961 @@ class DTree(Node):
 
         self.label = kwargs.get('label', '')
 
+        # journal=True keeps every change, a number only the latest ones.
+        journal = kwargs.get('journal')
+        if journal:
+            self.journal = Journal(None if journal is True else journal)
+
     def next_id(self):
         self.items += 1
         return self.items
 
-    def reindex(self, start=0):
-        def walk(_parent):
-            for _item in _parent:
-                _item.id = self.next_id()
-                if _item.is_node():
-                    walk(_item)
+    @_reads
+    def lookup(self, _id):
+        return _multi_items(self._index.get(_id))
+
+    @_reads
+    def named(self, name):
+        return _multi_items(self._named.get(name))
+
+    def _index_add(self, item):
+        # Ids are only unique per DTree, so nested trees created with parent=
+        # can share ids in the root index.
+        _multi_add(self._index, item.id, item)
+        _multi_add(self._named, item.name, item)
+        if self._grams is not None:
+            self._grams.add(item.name)
+
+    def _index_remove(self, item):
+        _multi_remove(self._index, item.id, item)
+        _multi_remove(self._named, item.name, item)
+
+    def _register(self, item):
+        self._index_add(item)
+        if isinstance(item, DTree) and item._index:
+            for found in item._index.values():
+                for child in _multi_items(found):
+                    self._index_add(child)
+            item._index = {}
+            item._named = {}
+            item._grams = None
+        elif isinstance(item, Node):
+            for child in item.walk():
+                self._index_add(child)
+
+        if self._gap:
+            self._place(item)
+        elif item._span is not None:
+            self._clear_spans(item)
+
+    def _unregister(self, item):
+        self._index_remove(item)
+        if isinstance(item, Node):
+            items = list(item.walk())
+            for child in items:
+                self._index_remove(child)
+
+            if isinstance(item, DTree):
+                for child in items:
+                    item._index_add(child)
+
+        if item._span is not None:
+            self._clear_spans(item)
+
+    @_writes
+    def number(self, gap=64):
+        # Gives every item of the whole tree nested set numbers, pre-order on
+        # the way down and post-order on the way up, so an item is under a
+        # node when its numbers fall between the node's. The numbers are
+        # spaced out and kept up by append, insert, move and delete, a full
+        # gap spreads out its neighbours and only a full tree makes them start
+        # over. gap=None turns them off.
+        root = self.root
+        root._gap = gap
+        if not gap:
+            root._clear_spans(root)
+            return
+
+        size = 1 + sum(1 for _ in root.walk())
+        root._number(root, 0, max(gap, size))
+
+    def _number(self, item, pre, step):
+        stack = [(item, pre, iter(item) if isinstance(item, Node) else iter(()))]
+        counter = pre
+        while stack:
+            node, pre, children = stack[-1]
+            for child in children:
+                counter += step
+                stack.append((child, counter, iter(child) if isinstance(child, Node) else iter(())))
+                break
+            else:
+                stack.pop()
+                counter += step
+                node._span = (pre, counter, self)
+        return counter
+
+    def _place(self, item):
+        # Numbers a new or moved item in the gap between its neighbours,
+        # spread out between two siblings and packed at the end of a list,
+        # where the next items are most likely to go.
+        parent = item.parent
+        idx = parent.index_of(item)
+        before = parent[idx - 1]._span if idx else parent._span
+        after = parent[idx + 1]._span if idx + 1 < len(parent) else None
+        if before is None or parent._span is None:
+            return self.number(self._gap)
+
+        low = before[1] if idx else before[0]
+        high = after[0] if after is not None else parent._span[1]
+        size = 1 + (sum(1 for _ in item.walk()) if isinstance(item, Node) else 0)
+        if high - low > 2 * size:
+            step = (high - low) // (2 * size + 1) if after is not None else 1
+            self._number(item, low + step, step)
+            return
+
+        # The gap is full: the smallest run of siblings around the item with
+        # room is spread out again, doubling the run up to the whole parent
+        # and then going on with the parent. Only a full tree starts over.
+        node = item
+        while node is not self:
+            parent = node.parent
+            idx = parent.index_of(node)
+            width = 2
+            while not self._spread(parent, idx - idx % width, idx - idx % width + width):
+                if width >= len(parent):
+                    break
+                width *= 2
+            else:
+                return
+            node = parent
+        self.number(self._gap)
+
+    def _spread(self, parent, start, stop):
+        # Renumbers parent[start:stop] evenly between their neighbours when
+        # that leaves a step that grows with the number of items moved, so
+        # that the runs renumbered often stay small.
+        items = parent[start:stop]
+        low = parent[start - 1]._span[1] if start else parent._span[0]
+        high = parent._span[1]
+        # Siblings populate() has yet to place have no numbers.
+        for item in islice(parent, stop, None):
+            if item._span is not None:
+                high = item._span[0]
+                break
+        size = sum(1 + (sum(1 for _ in item.walk()) if isinstance(item, Node) else 0) for item in items)
+        step = (high - low) // (2 * size + 1)
+        if step < 2 + size.bit_length():
+            return False
+
+        counter = low
+        for item in items:
+            counter = self._number(item, counter + step, step)
+        return True
+
+    @staticmethod
+    def _clear_spans(item):
+        item._span = None
+        if isinstance(item, Node):
+            for child in item.walk():
+                child._span = None
+
+    def _check_store(self, item):
+        store = self.store
+        items = [item]
+        if isinstance(item, Node) and not isinstance(item, DTree):
+            items += item.members()
+
+        for child in items:
+            columns = child.columns
+            if len(columns) > store.width:
+                message = f'{child.path()} has more columns than the tree stores.'
+                raise ValueError(message)
+            elif not store.fits(columns):
+                message = f'{child.path()} has a value its column type cannot hold.'
+                raise ValueError(message)
+
+    def _store_attach(self, item, parent):
+        store = self.store
+        if self._ordered:
+            last = self._last
+            self._ordered = last is parent or last.is_under(parent)
+
+        store.set_row(item.id, item.columns)
+        item._columns = store
+        self._last = item
+
+        if isinstance(item, Node) and not isinstance(item, DTree) and len(item):
+            # A subtree moved in from elsewhere takes ids from this tree.
+            self._ordered = False
+            for child in item.members():
+                values = child.columns
+                child.id = self.next_id()
+                store.set_row(child.id, values)
+                child._columns = store
+
+    def _store_detach(self, item):
+        store = self.store
+        items = [item]
+        if isinstance(item, Node) and not isinstance(item, DTree):
+            items += item.members()
+
+        for child in items:
+            if child._columns is store:
+                child._columns = store.row(child.id)
+                store.clear(child.id)
+            if child is self._last:
+                self._ordered = False
+
+    def reading(self):
+        # Holds off writers while the caller iterates, walk() and select()
+        # are generators and cannot lock for the caller.
+        lock = self.root.lock
+        return lock.reading() if lock is not None else nullcontext()
+
+    def writing(self):
+        lock = self.root.lock
+        return lock.writing() if lock is not None else nullcontext()
+
+    def settings(self):
+        store = self.store
+        return {
+            'name': self.name,
+            'label': self.label,
+            'items': self.items,
+            'errors': self.errors,
+            'unique': self.unique,
+            'data_columns': list(self.data_columns),
+            'columnar': store is not None,
+            'column_types': list(store.types) if store is not None else None,
+            'concurrent': self.lock is not None,
+            'journal': (self.journal.size or True) if self.journal is not None else False,
+        }
+
+    @property
+    def version(self):
+        journal = self.root.journal
+        return journal.version if journal is not None else None
+
+    def _journal(self):
+        journal = self.root.journal
+        if journal is None:
+            message = 'tree has no journal, create it with journal=True.'
+            raise ValueError(message)
+        return journal
+
+    @_reads
+    def changes_since(self, version):
+        return self._journal().since(version)
+
+    def subscribe(self, callback):
+        self._journal().subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._journal().subscribers.remove(callback)
+
+    @_reads
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(Snapshot.dump(self))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return Snapshot(f.read()).materialize()
+
+    @classmethod
+    def open(cls, path):
+        # Maps the snapshot instead of reading it, so processes opening the
+        # same file share its pages. Items are made as they are reached.
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Snapshot(buffer).mapped()
+
+    @_writes
+    def reindex(self, start=0, spans=False):
+        root = self.root
+        items = list(self.walk())
+        for item in items:
+            root._index_remove(item)
+
+        rows = [(item, item.columns) for item in items if type(item._columns) is not tuple]
+        for item, _ in rows:
+            item._columns.clear(item.id)
 
         self.items = start
-        for item in self:
+        for item in items:
             item.id = self.next_id()
-            if item.is_node():
-                walk(item)
+            root._index_add(item)
+
+        for item, values in rows:
+            item._columns.set_row(item.id, values)
+
+        # Nested trees were renumbered from this tree's counter, carry on
+        # from there so new ids do not collide with the renumbered ones.
+        for tree in [self] + [item for item in items if isinstance(item, DTree)]:
+            tree.items = max(tree.items, self.items)
+            tree._ordered = True
+            tree._last = tree.last()
+
+        if spans:
+            self.number(root._gap or 64)
+        _log(self, 'reindex')
+
+
+class Query:
+    # A path glob with column conditions, compiled once and run against any
+    # node. Segments are names with * and ?, '**' spans any number of levels
+    # and a leading '/' starts at the tree. where maps the name, the id, a
+    # data column or the name of a child leaf holding the value to a value
+    # or an (op, value) pair. Results stream in tree order unless order is
+    # given.
+    ops = {
+        '==': eq, '!=': ne, '<': lt, '<=': le, '>': gt, '>=': ge,
+        'in': lambda value, values: value in values,
+        'like': lambda value, pattern: isinstance(value, str) and fnmatchcase(value, pattern),
+    }
+
+    def __init__(self, path='*', where=None, order=None, limit=None, reverse=False):
+        self.absolute = path.startswith('/')
+        self.segments = path.strip('/').split('/')
+        self.order = order
+        self.limit = limit
+        self.reverse = reverse
+
+        self.matchers = []
+        for segment in self.segments:
+            if segment == '**':
+                self.matchers.append(None)
+            elif '*' in segment or '?' in segment:
+                self.matchers.append(re.compile(self._translate(segment) + r'\Z').match)
+            else:
+                self.matchers.append(segment)
+
+        parts = []
+        for idx, segment in enumerate(self.segments):
+            last = idx == len(self.segments) - 1
+            if segment == '**':
+                parts.append('.+' if last else '(?:[^/]*/)*')
+            else:
+                parts.append(self._translate(segment) + ('' if last else '/'))
+        self.pattern = re.compile(''.join(parts) + r'\Z')
+
+        # The name index is worth it from the first literal segment below a
+        # wildcard, a literal first segment is a child lookup anyway. Below a
+        # '**' only a literal last segment can use it.
+        self.pivot = None
+        for idx, matcher in enumerate(self.matchers):
+            if matcher is None:
+                break
+            elif isinstance(matcher, str):
+                self.pivot = idx if idx else None
+                break
+
+        self.where = []
+        self.id = None
+        if callable(where):
+            self.where = where
+            return
+
+        for name, condition in (where or {}).items():
+            op, value = condition if isinstance(condition, tuple) else ('==', condition)
+            if op not in self.ops:
+                message = f'unknown operator {op}.'
+                raise ValueError(message)
+            elif name == 'id' and op == '==':
+                self.id = value
+            self.where.append((name, self.ops[op], value))
+
+    @staticmethod
+    def _translate(segment):
+        return ''.join('[^/]*' if part == '*' else '[^/]' if part == '?' else re.escape(part)
+                       for part in re.split(r'([*?])', segment))
+
+    def run(self, node):
+        start = node.tree if self.absolute else node
+        items = (item for item in self._candidates(start) if self.test(item))
+        if self.order is None:
+            yield from islice(items, self.limit)
+            return
+
+        # Items without the value come last whichever way the order goes.
+        def key(item):
+            value = self.value(item, self.order)
+            return (value is None) != self.reverse, value
+
+        if self.limit is None:
+            yield from sorted(items, key=key, reverse=self.reverse)
+        else:
+            yield from (nlargest if self.reverse else nsmallest)(self.limit, items, key=key)
+
+    def test(self, item):
+        if callable(self.where):
+            return self.where(item)
+
+        for name, op, value in self.where:
+            found = self.value(item, name)
+            try:
+                if found is None or not op(found, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    @staticmethod
+    def value(item, name):
+        if name == 'name':
+            return item.name
+        elif name == 'id':
+            return item.id
+
+        tree = item.tree
+        if tree is not None and name in tree.data_columns:
+            columns = item.columns
+            idx = tree.data_columns.index(name)
+            return columns[idx] if idx < len(columns) else None
+        elif isinstance(item, Node):
+            child = item.child(name)
+            if child is not None and not isinstance(child, Node) and child.columns:
+                return child.columns[0]
+
+    def _candidates(self, start):
+        root = start.root
+        if self.id is not None and root is not None:
+            found = [item for item in root.lookup(self.id) if item.is_under(start) and self._matches(item, start)]
+            yield from sorted(found, key=lambda item: item.position(start))
+            return
+
+        last = self.matchers[-1]
+        if self.pivot is None and isinstance(last, str) and len(self.matchers) > 1 and root is not None:
+            found = root._named.get(last)
+            if not isinstance(found, dict) or len(found) <= 1024:
+                found = [item for item in _multi_items(found) if item.is_under(start) and self._matches(item, start)]
+                yield from sorted(found, key=lambda item: item.position(start))
+                return
+
+        stack = [(start, 0)]
+        if self.pivot is not None and root is not None:
+            found = root._named.get(self.segments[self.pivot])
+            if not isinstance(found, dict) or len(found) <= 1024:
+                found = [item for item in _multi_items(found) if self._leads_to(item, start)]
+                found.sort(key=lambda item: item.position(start), reverse=True)
+                stack = [(item, self.pivot + 1) for item in found]
+
+        offset = None
+        while stack:
+            item, idx = stack.pop()
+            if idx == len(self.matchers):
+                yield item
+                continue
+            elif not isinstance(item, Node):
+                continue
+
+            matcher = self.matchers[idx]
+            if matcher is None:
+                # The rest of the path may span any number of levels, test
+                # the whole relative path of everything below.
+                if offset is None:
+                    offset = len(start.path()) + 1
+                for child in item.walk():
+                    if self.pattern.match(child.path()[offset:]):
+                        yield child
+            elif isinstance(matcher, str):
+                stack.extend((child, idx + 1) for child in reversed(self._children(item, matcher)))
+            else:
+                stack.extend((child, idx + 1) for child in reversed(item)
+                             if isinstance(child.name, str) and matcher(child.name))
+
+    def _children(self, node, name):
+        child = node.child(name)
+        if child is None:
+            return []
+
+        names = node._names
+        if names is None:
+            return [child for child in node if child.name == name]
+        found = names.get(name)
+        return sorted(found.values(), key=node.index_of) if isinstance(found, dict) else [found]
+
+    def _leads_to(self, item, start):
+        for matcher in reversed(self.matchers[:self.pivot]):
+            item = item.parent
+            if item is None or item is start:
+                return False
+            elif not isinstance(matcher, str):
+                if not isinstance(item.name, str) or not matcher(item.name):
+                    return False
+            elif item.name != matcher:
+                return False
+        return item.parent is start
+
+    def _matches(self, item, start):
+        return bool(self.pattern.match(item.path()[len(start.path()) + 1:]))
+
+
+def _build_shard(shard, loader, settings):
+    # A shard is a (name, data) pair for populate or the path of a saved
+    # tree, either given as is or returned by the loader.
+    if loader is not None:
+        shard = loader(shard)
+    if isinstance(shard, (str, os.PathLike)):
+        with open(shard, 'rb') as f:
+            return f.read()
+
+    name, data = shard
+    tree = DTree(name=name, **settings)
+    tree.populate(data, bulk=True)
+    return Snapshot.dump(tree)
+
+
+class Snapshot:
+    # Binary layout of a saved DTree. The items are stored in pre-order as
+    # parallel arrays (parent index, kind, id, subtree size, name and the
+    # offset of their columns), column values as a tag and an 8 byte value
+    # each, and every string once in a string table. Sections are found
+    # through a directory after the header, so a buffer is read in place.
+    magic = b'DTRE'
+    version = 1
+    null = -2 ** 63
+
+    header = struct.Struct('<4sHBxI')
+    entry = struct.Struct('<4sQQ')
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, version, little, count = self.header.unpack_from(view)
+        if magic != self.magic or version != self.version:
+            message = 'not a DTree snapshot or an unsupported version.'
+            raise ValueError(message)
+        elif little != (sys.byteorder == 'little'):
+            message = 'snapshot was written on a machine with a different byte order.'
+            raise ValueError(message)
+
+        sections = {}
+        for idx in range(count):
+            name, offset, length = self.entry.unpack_from(view, self.header.size + idx * self.entry.size)
+            sections[name.decode()] = view[offset:offset + length]
+
+        self.buffer = buffer
+        self.parents = sections['PRNT'].cast('i')
+        self.kinds = sections['KIND'].cast('B')
+        self.ids = sections['IDNT'].cast('q')
+        self.sizes = sections['SIZE'].cast('i')
+        self.name_tags = sections['NTAG'].cast('B')
+        self.name_values = sections['NVAL'].cast('q')
+        self.name_floats = sections['NVAL'].cast('d')
+        self.offsets = sections['COFF'].cast('q')
+        self.value_tags = sections['VTAG'].cast('B')
+        self.values = sections['VVAL'].cast('q')
+        self.floats = sections['VVAL'].cast('d')
+        self.string_offsets = sections['SOFF'].cast('q')
+        self.strings = sections['SDAT']
+        self.meta = json.loads(bytes(sections['META']).decode())
+        self._texts = None
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def string(self, idx):
+        return bytes(self.strings[self.string_offsets[idx]:self.string_offsets[idx + 1]]).decode()
+
+    def texts(self):
+        if self._texts is None:
+            data, offsets = bytes(self.strings), self.string_offsets.tolist()
+            self._texts = [data[start:stop].decode() for start, stop in zip(offsets, offsets[1:])]
+        return self._texts
+
+    def decode(self, tags, values, floats, start=0, stop=None):
+        # Values are decoded a slice at a time, most of them are ints or
+        # strings and only need the string table looked up. A whole table is
+        # decoded against texts(), the items a mapped tree makes one at a
+        # time read their few strings straight from the buffer.
+        text = self.texts().__getitem__ if stop is None or self._texts is not None else self.string
+        stop = len(tags) if stop is None else stop
+        result = values[start:stop].tolist()
+        for idx, _tag in enumerate(tags[start:stop]):
+            if _tag == tag.INT:
+                continue
+            elif _tag == tag.STR:
+                result[idx] = text(result[idx])
+            elif _tag == tag.NONE:
+                result[idx] = None
+            elif _tag == tag.FLOAT:
+                result[idx] = floats[start + idx]
+            elif _tag == tag.BOOL:
+                result[idx] = bool(result[idx])
+            else:
+                result[idx] = json.loads(text(result[idx]))
+        return result
+
+    def name(self, idx):
+        return self.decode(self.name_tags, self.name_values, self.name_floats, idx, idx + 1)[0]
+
+    def columns(self, idx):
+        return tuple(self.decode(self.value_tags, self.values, self.floats, self.offsets[idx], self.offsets[idx + 1]))
+
+    def item_id(self, idx):
+        _id = self.ids[idx]
+        return None if _id == self.null else _id
+
+    def children(self, idx):
+        child, stop = idx + 1, idx + self.sizes[idx]
+        while child < stop:
+            yield child
+            child += self.sizes[child]
+
+    def settings(self, idx):
+        return self.meta['trees'][str(idx)]
+
+    def materialize(self, parent=None):
+        # With a parent the saved tree is grafted below it as a node: its
+        # items take the next block of the parent tree's ids in pre-order and
+        # are indexed by its root, trees nested in the snapshot keep theirs.
+        names = self.decode(self.name_tags, self.name_values, self.name_floats)
+        values = self.decode(self.value_tags, self.values, self.floats)
+        parents, kinds, ids, offsets = (view.tolist() for view in (self.parents, self.kinds, self.ids, self.offsets))
+
+        tree = root = None
+        owned = [False] * len(kinds)
+        if parent is not None:
+            tree = parent.tree
+            root = tree.root
+            owned = self._check_graft(parent, tree, names[0], parents, kinds, offsets, values)
+            if tree.store is not None and tree._ordered:
+                last = tree._last
+                tree._ordered = last is parent or last.is_under(parent)
+            width = len(tree.data_columns)
+            _id = tree.items
+
+        # Ids given out here are new to the tree, so the index entries are
+        # set in one step and only fall back when a nested tree shares them.
+        index = named = None
+        if root is not None:
+            index, named = root._index, root._named
+            root._grams = None
+
+        items = []
+        trees = []
+        last = None
+        for idx, _kind in enumerate(kinds):
+            up = items[parents[idx]] if idx else parent
+            if _kind == kind.TREE and (idx or parent is None):
+                settings = dict(self.settings(idx))
+                counter, ordered = settings.pop('items'), settings.pop('ordered')
+                item = DTree(**settings)
+                item.items = counter
+                item._ordered = ordered
+                trees.append(item)
+            else:
+                item = Leaf.__new__(Leaf) if _kind == kind.LEAF else Node.__new__(Node)
+                item._tree = up._tree if idx else tree
+                item._path = None
+                item._span = None
+                if _kind != kind.LEAF:
+                    item._names = None
+
+            item._name = name = names[idx]
+            item._columns = tuple(values[offsets[idx]:offsets[idx + 1]])
+            if owned[idx]:
+                _id += 1
+                item.id = _id
+                last = item
+                if len(item._columns) < width:
+                    item._columns += (None, ) * (width - len(item._columns))
+            else:
+                item.id = None if ids[idx] == self.null else ids[idx]
+            item.parent = up
+            if up is not None:
+                list.append(up, item)
+                store = (up._tree if idx else tree).store
+                if store is not None:
+                    store.set_row(item.id, item._columns)
+                    item._columns = store
+            if index is None:
+                index, named = item._index, item._named
+            else:
+                if index.setdefault(item.id, item) is not item:
+                    _multi_add(index, item.id, item)
+                found = named.setdefault(name, item)
+                if isinstance(found, dict):
+                    found[id(item)] = item
+                elif found is not item:
+                    _multi_add(named, name, item)
+            items.append(item)
+
+        for item in trees:
+            item._last = item.last()
+        if parent is None:
+            return items[0]
+
+        top = items[0]
+        parent._names_add(top, last=True)
+        tree.items = _id
+        if tree.store is not None:
+            tree._last = last
+        if root is not None and root._gap:
+            root._place(top)
+        return top
+
+    @staticmethod
+    def _check_graft(parent, tree, name, parents, kinds, offsets, values):
+        if tree.unique and tree.errors != 'ignore' and parent.child(name) is not None:
+            message = f'duplicate name {parent.path()}/{name} found.'
+            raise ValueError(message)
+
+        # An item belongs to the tree it is grafted into unless a tree nested
+        # in the snapshot sits between them.
+        owned = [True]
+        for idx in range(1, len(kinds)):
+            up = parents[idx]
+            owned.append(owned[up] and (not up or kinds[up] != kind.TREE))
+
+        store = tree.store
+        if store is not None:
+            rows = [values[a:b] for a, b, mine in zip(offsets, offsets[1:], owned) if mine]
+            if any(len(row) > store.width for row in rows):
+                message = f'{parent.path()}/{name} has more columns than the tree stores.'
+                raise ValueError(message)
+            elif not all(store.fits(row) for row in rows):
+                message = f'{parent.path()}/{name} has a value its column type cannot hold.'
+                raise ValueError(message)
+        return owned
+
+    @classmethod
+    def dump(cls, tree):
+        strings = {}
+
+        def string(text):
+            idx = strings.get(text)
+            if idx is None:
+                idx = strings[text] = len(strings)
+            return idx
+
+        def encode(value):
+            if value is None:
+                return tag.NONE, 0
+            elif isinstance(value, bool):
+                return tag.BOOL, int(value)
+            elif isinstance(value, int) and cls.null < value < -cls.null:
+                return tag.INT, value
+            elif isinstance(value, float):
+                return tag.FLOAT, struct.unpack('<q', struct.pack('<d', value))[0]
+            elif isinstance(value, str):
+                return tag.STR, string(value)
+            return tag.JSON, string(json.dumps(value))
+
+        parents, kinds, ids, sizes = array('i'), array('B'), array('q'), array('i')
+        name_tags, name_values = array('B'), array('q')
+        offsets, value_tags, values = array('q', [0]), array('B'), array('q')
+        meta = {'trees': {}}
+
+        position = {}
+        for idx, item in enumerate([tree] + list(tree.walk())):
+            position[id(item)] = idx
+            parents.append(position[id(item.parent)] if idx else -1)
+            ids.append(cls.null if item.id is None else item.id)
+            sizes.append(1)
+
+            if isinstance(item, DTree):
+                kinds.append(kind.TREE)
+                meta['trees'][str(idx)] = dict(item.settings(), ordered=item._ordered)
+            else:
+                kinds.append(kind.NODE if isinstance(item, Node) else kind.LEAF)
+
+            _tag, value = encode(item.name)
+            name_tags.append(_tag)
+            name_values.append(value)
+
+            for column in item.columns:
+                _tag, value = encode(column)
+                value_tags.append(_tag)
+                values.append(value)
+            offsets.append(len(values))
+
+        for idx in range(len(parents) - 1, 0, -1):
+            sizes[parents[idx]] += sizes[idx]
+
+        data = bytearray()
+        string_offsets = array('q', [0])
+        for text in strings:
+            data += text.encode()
+            string_offsets.append(len(data))
+
+        sections = [
+            (b'PRNT', parents), (b'KIND', kinds), (b'IDNT', ids), (b'SIZE', sizes),
+            (b'NTAG', name_tags), (b'NVAL', name_values), (b'COFF', offsets), (b'VTAG', value_tags),
+            (b'VVAL', values), (b'SOFF', string_offsets), (b'SDAT', data), (b'META', json.dumps(meta).encode()),
+        ]
+
+        # Sections start on 8 byte boundaries so they can be cast in place.
+        offset = cls.header.size + cls.entry.size * len(sections)
+        directory, body = [], bytearray()
+        for name, section in sections:
+            section = bytes(section)
+            start = offset + len(body)
+            padding = -start % 8
+            body += bytes(padding)
+            directory.append(cls.entry.pack(name, start + padding, len(section)))
+            body += section
+
+        header = cls.header.pack(cls.magic, cls.version, sys.byteorder == 'little', len(sections))
+        return header + b''.join(directory) + bytes(body)
+
+    def mapped(self):
+        # Items are made the first time their parent's children are read,
+        # the ones made so far are kept by position for the root index.
+        self.loaded = {}
+        self.lock = threading.Lock()
+        return self.make(0, None)
+
+    def make(self, idx, parent):
+        _kind = self.kinds[idx]
+        if _kind == kind.TREE:
+            item = MappedTree(self, idx)
+        else:
+            item = MappedLeaf.__new__(MappedLeaf) if _kind == kind.LEAF else MappedNode.__new__(MappedNode)
+            item._tree = parent._tree
+            item._path = None
+            item._span = None
+            item._name = self.name(idx)
+            if _kind == kind.NODE:
+                item._names = None
+                item._idx = idx
+
+        item.id = self.item_id(idx)
+        item._columns = self.columns(idx)
+        item.parent = parent
+        self.loaded[idx] = item
+        return item
+
+    def load(self, node):
+        # _idx is cleared last, a node without one has all its children.
+        with self.lock:
+            idx = node._idx
+            if idx is not None:
+                list.extend(node, [self.make(child, node) for child in self.children(idx)])
+                node._idx = None
+
+    def item(self, idx):
+        chain = []
+        while idx not in self.loaded:
+            chain.append(idx)
+            idx = self.parents[idx]
+
+        for idx in reversed(chain):
+            parent = self.loaded[self.parents[idx]]
+            if parent._idx is not None:
+                self.load(parent)
+        return self.loaded[idx]
+
+
+class MappedIndex:
+    # Root index of a mapped tree. The keys are read from the snapshot the
+    # first time it is used and only the items looked up are made.
+    def __init__(self, snapshot, keys):
+        self.snapshot = snapshot
+        self.keys = keys
+        self.positions = None
+
+    def _build(self):
+        positions = self.positions = {}
+        for idx, key in enumerate(self.keys()):
+            if not idx:
+                continue
+            found = positions.get(key)
+            if found is None:
+                positions[key] = idx
+            elif isinstance(found, list):
+                found.append(idx)
+            else:
+                positions[key] = [found, idx]
+        return positions
+
+    def get(self, key, default=None):
+        positions = self.positions if self.positions is not None else self._build()
+        found = positions.get(key)
+        if found is None:
+            return default
+        elif not isinstance(found, list):
+            return self.snapshot.item(found)
+
+        items = [self.snapshot.item(idx) for idx in found]
+        return {id(item): item for item in items}
+
+    def __iter__(self):
+        return iter(self.positions if self.positions is not None else self._build())
+
+    def __len__(self):
+        return len(self.positions if self.positions is not None else self._build())
+
+
+class Mapped:
+    # Items of a tree opened with DTree.open(), they are read-only.
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        message = f'{self.name} belongs to a read-only tree.'
+        raise ValueError(message)
+
+    def _rename(self, value):
+        if self.parent is not None:
+            self._read_only()
+        Base.name.fset(self, value)
+
+    name = property(Base.name.fget, _rename)
+    columns = property(Base.columns.fget, _read_only)
+    delete = _read_only
+
+
+class MappedLeaf(Mapped, Leaf):
+    __slots__ = ()
+
+
+class MappedNode(Mapped, Node):
+    __slots__ = ('_idx',)
+
+    append = insert = populate = move = delete_many = graft = populate_sharded = Mapped._read_only
+    __setitem__ = __delitem__ = __iadd__ = Mapped._read_only
+    extend = pop = remove = clear = sort = reverse = Mapped._read_only
+
+    def _load(self):
+        if self._idx is not None:
+            self._tree._snapshot.load(self)
+
+    def __iter__(self):
+        self._load()
+        return list.__iter__(self)
+
+    def __reversed__(self):
+        self._load()
+        return list.__reversed__(self)
+
+    def __len__(self):
+        self._load()
+        return list.__len__(self)
+
+    def __getitem__(self, idx):
+        self._load()
+        return list.__getitem__(self, idx)
+
+    def __contains__(self, item):
+        self._load()
+        return list.__contains__(self, item)
+
+
+class MappedTree(MappedNode, DTree):
+    reindex = Mapped._read_only
+
+    def __init__(self, snapshot, idx):
+        settings = dict(snapshot.settings(idx))
+        counter = settings.pop('items')
+        settings.pop('ordered')
+        DTree.__init__(self, **dict(settings, columnar=False, journal=False))
+
+        self.items = counter
+        self._idx = idx
+        self._snapshot = snapshot
+        if not idx:
+            self._index = MappedIndex(snapshot, lambda: [snapshot.item_id(i) for i in range(len(snapshot))])
+            self._named = MappedIndex(snapshot, lambda: snapshot.decode(
+                snapshot.name_tags, snapshot.name_values, snapshot.name_floats))
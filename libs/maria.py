@@ -5,12 +5,23 @@
 ########################################################################################################################
 import os
 import time
+import threading
 import logging as lg
 
+from csv import reader
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from tempfile import NamedTemporaryFile
 from pymysql import connect
+from pymysql.cursors import SSCursor
+from pymysql.err import InterfaceError, MySQLError, OperationalError
 
 version = '0.1'
 
+# Server and client errors for a LOAD DATA LOCAL INFILE that is not allowed.
+LOCAL_INFILE_REFUSED = (1148, 2068, 3948, 4166)
+
 
 class MariaDB:
     def __init__(self, **kwargs):
@@ -22,6 +33,8 @@ class MariaDB:
         self.db_user = None
         self.db_password = None
         self.charset = None
+        self.local_infile = False
+        self.schema = {}
 
         log_file = kwargs.get('log_file', 'maria.log')
         log_level = kwargs.get('log_level', lg.DEBUG)
@@ -37,6 +50,8 @@ class MariaDB:
         sql = f'USE {database}'
         try:
             self.cursor.execute(sql)
+            if database != self.db_name:
+                self.schema.clear()
             self.db_name = database
             self.set_autocommit(autocommit=kwargs.get('autocommit', True))
             lg.info(f'use:{sql}')
@@ -89,13 +104,16 @@ class MariaDB:
         self.db_user = info['user']
         self.db_password = info['password']
         self.charset = info.get('charset', None)
+        self.local_infile = info.get('local_infile', False)
 
         database = self.db_name = kwargs.get('database', database)
+        self.schema.clear()
 
         try:
             self.conn = connect(
                 host=self.host, port=self.port,
-                user=self.db_user, passwd=self.db_password, charset=self.charset)
+                user=self.db_user, passwd=self.db_password, charset=self.charset,
+                local_infile=self.local_infile)
 
             self.cursor = self.conn.cursor()
 
@@ -133,10 +151,32 @@ class MariaDB:
         finally:
             pass
 
+    def iter_query(self, sql, args=None, batch_size=1000, batches=False):
+        # Rows are read from an unbuffered server side cursor a batch at a time, so memory stays flat however large
+        # the result is. The connection is busy until the generator is exhausted or closed, queries run meanwhile
+        # need a connection of their own, see pool().
+        cursor = self.conn.cursor(SSCursor)
+        try:
+            lg.info(f'iter_query:{sql}')
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                elif batches:
+                    yield rows
+                else:
+                    yield from rows
+        except Exception as err:
+            lg.error(f'iter_query:{str(err)}:{sql}')
+        finally:
+            cursor.close()
+
     def drop_table(self, table):
         sql = f'DROP TABLE {table}'
         try:
             lg.info(f'drop_table:{sql}')
+            self.refresh_schema(table)
             return self.cursor.execute(sql)
         except Exception as err:
             lg.error(f'drop_table:{str(err)}:{sql}')
@@ -145,6 +185,7 @@ class MariaDB:
         sql = f'DROP INDEX {index} ON {table};'
         try:
             lg.info(f'drop_index:{sql}')
+            self.refresh_schema(table)
             return self.cursor.execute(sql)
         except Exception as err:
             lg.error(f'drop_index:{str(err)}:{sql}')
@@ -154,6 +195,7 @@ class MariaDB:
         sql = f'DROP DATABASE {database};'
         try:
             lg.info(f'drop_database:{sql}')
+            self.refresh_schema(database=database)
             return self.cursor.execute(sql)
         except Exception as err:
             lg.error(f'drop_database:{str(err)}:{sql}')
@@ -166,6 +208,7 @@ class MariaDB:
         try:
             lg.info('create_table:' + sql)
             if database == self.db_name:
+                self.refresh_schema(table)
                 return self.cursor.execute(sql, (database_engine,))
         except Exception as err:
             lg.error(f'create_table:{str(err)}:{sql}')
@@ -174,6 +217,7 @@ class MariaDB:
         sql = f'CREATE INDEX {index} ON {table}({column});'
         try:
             lg.info(f'create_index:{sql}')
+            self.refresh_schema(table)
             return self.cursor.execute(sql)
         except Exception as err:
             lg.error(f'create_index:{str(err)}:{sql}')
@@ -236,10 +280,10 @@ class MariaDB:
             lg.error(f'database_exist:{str(err)}')
 
     def insert_row(self, table, row):
-        column_names = []
-
-        for name in self.get_columns_metadata(table):
-            column_names.append(name[3])
+        schema = self.get_schema(table)
+        if not schema:
+            return
+        column_names = schema['columns']
 
         sql = f"INSERT INTO {table} ({','.join(column_names[1:])}) VALUES ({('%s,' * len(row)).rstrip(',')});"
         try:
@@ -248,12 +292,101 @@ class MariaDB:
         except Exception as err:
             lg.error(f'insert_row:{str(err)}:{sql}:{row}')
 
+    def insert_rows(self, table, rows, chunk_size=1000, commit=True, ignore=False, columns=None):
+        if columns is None:
+            schema = self.get_schema(table)
+            if not schema:
+                return 0
+            columns = schema['columns'][1:]
+
+        # pymysql turns executemany on a plain INSERT into multi-row INSERT statements. With commit each chunk is
+        # a transaction of its own, otherwise the rows go in under the connection's autocommit or the caller's
+        # transaction. With ignore rows that would break a unique key are skipped, on any other error the failed
+        # chunk is rolled back and the number of rows written so far is returned.
+        count = 0
+        rows = iter(rows)
+        sql = None
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            if sql is None:
+                sql = f"INSERT {'IGNORE ' if ignore else ''}INTO {table} ({','.join(columns)}) " \
+                      f"VALUES ({('%s,' * len(chunk[0])).rstrip(',')});"
+                lg.info(f'insert_rows:{sql}')
+            try:
+                if commit:
+                    self.conn.begin()
+                written = self.cursor.executemany(sql, chunk)
+                if commit:
+                    self.conn.commit()
+                count += written
+            except Exception as err:
+                if commit:
+                    self.conn.rollback()
+                lg.error(f'insert_rows:{str(err)}:{sql}:{count}')
+                break
+
+        return count
+
+    def load_csv(self, table, path, columns=None, transforms=None, **kwargs):
+        ignore = kwargs.get('ignore', False)
+
+        def rows():
+            with open(path, newline='', encoding=kwargs.get('encoding'), errors=kwargs.get('errors')) as f:
+                results = reader(f, delimiter=kwargs.get('delimiter', ','), quotechar=kwargs.get('quotechar', '"'))
+                for row in islice(results, kwargs.get('skip', 0), None):
+                    for transform in transforms or ():
+                        row = transform(row)
+                        if row is None:
+                            break
+                    else:
+                        yield row
+
+        def field(value):
+            if value is None:
+                return '\\N'
+            return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+        if columns is None:
+            schema = self.get_schema(table)
+            if not schema:
+                return 0
+            columns = schema['columns'][1:]
+
+        # Transforms map a csv row to the row to load or to None to skip it. The rows are staged in the default
+        # format of LOAD DATA, tab separated with \N for NULL. Without LOCAL INFILE (connect with local_infile in
+        # the connection info) the rows are inserted in chunks instead. When the server refuses it the csv is read
+        # again for that, so transforms should not depend on being called once.
+        chunk_size = kwargs.get('chunk_size', 1000)
+        if not self.local_infile:
+            return self.insert_rows(table, rows(), chunk_size=chunk_size, ignore=ignore, columns=columns)
+
+        with NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv') as staged:
+            for row in rows():
+                staged.write('\t'.join(field(value) for value in row) + '\n')
+            staged.flush()
+
+            sql = f"LOAD DATA LOCAL INFILE %s {'IGNORE ' if ignore else ''}INTO TABLE {table} " \
+                  f"CHARACTER SET utf8mb4 ({','.join(columns)});"
+            try:
+                lg.info(f'load_csv:{sql}:{path}')
+                return self.cursor.execute(sql, (staged.name,))
+            except Exception as err:
+                lg.error(f'load_csv:{str(err)}:{sql}:{path}')
+                if not isinstance(err, MySQLError) or not err.args or err.args[0] not in LOCAL_INFILE_REFUSED:
+                    return 0
+
+        return self.insert_rows(table, rows(), chunk_size=chunk_size, ignore=ignore, columns=columns)
+
     def update_row(self, table, _id, *args):
-        column_names = []
+        schema = self.get_schema(table)
+        if not schema:
+            return
+        column_names = schema['columns']
 
         data = args[0]
-        for name in self.get_columns_metadata(table):
-            column_names.append(name[3])
 
         parts = ''
         sql = f'UPDATE {table} SET '
@@ -268,7 +401,10 @@ class MariaDB:
             lg.error(f'update_row:{str(err)}:{sql}')
 
     def update_columns(self, table, _id, columns, data):
-        column_names = []
+        schema = self.get_schema(table)
+        if not schema:
+            return
+        column_names = schema['columns']
 
         if not isinstance(columns, list) or not isinstance(columns, tuple):
             columns = (columns, )
@@ -276,9 +412,6 @@ class MariaDB:
         if not isinstance(data, list) or not isinstance(data, tuple):
             data = (data, )
 
-        for name in self.get_columns_metadata(table):
-            column_names.append(name[3])
-
         sql = f'UPDATE {table} SET '
         for column, content in zip(columns, data):
             cname = column_names[column] if isinstance(column, int) else column
@@ -372,6 +505,47 @@ class MariaDB:
         except Exception as err:
             lg.error(f'get_columns_metadata:{str(err)}:{sql}')
 
+    def get_schema(self, table, **kwargs):
+        database = kwargs.get('database', self.db_name)
+
+        # Column names, types and the primary key of a table, read from information_schema once and kept until
+        # the table or the database changes or refresh_schema() is called.
+        key = (database, table)
+        schema = self.schema.get(key)
+        if schema is None:
+            rows = self.get_columns_metadata(table, database=database)
+            if not rows:
+                return
+
+            rows = sorted(rows, key=lambda row: row[4])
+            schema = self.schema[key] = {
+                'columns': tuple(row[3] for row in rows),
+                'types': tuple(row[15] for row in rows),
+                'primary_key': tuple(row[3] for row in rows if row[16] == 'PRI'),
+            }
+        return schema
+
+    def refresh_schema(self, table=None, **kwargs):
+        database = kwargs.get('database', self.db_name)
+
+        if table:
+            self.schema.pop((database, table), None)
+        else:
+            for key in [key for key in self.schema if key[0] == database]:
+                del self.schema[key]
+        return True
+
+    def pool(self, **kwargs):
+        connection = {
+            'host': self.host,
+            'port': self.port,
+            'user': self.db_user,
+            'password': self.db_password,
+            'charset': self.charset,
+            'local_infile': self.local_infile,
+        }
+        return ConnectionPool(connection, kwargs.pop('database', self.db_name), **kwargs)
+
     #############################################
 
     def set_autocommit(self, **kwargs):
@@ -405,3 +579,134 @@ class MariaDB:
                     return rows
             except Exception as err:
                 lg.error(f'get_table_status:{str(err)}:{sql}')
+
+
+class ConnectionPool:
+    # Hands out pymysql connections to one database from any thread. Idle connections are reused last in first out
+    # and pinged, reconnecting if the server dropped them, before they are handed out. Connections idle for longer
+    # than idle_timeout are closed down to min_size, a checkout waits for up to timeout seconds once max_size are
+    # in use. A connection that fails with a connection error inside connection() is dropped instead of reused.
+    def __init__(self, connection, database=None, **kwargs):
+        self.info = connection
+        self.database = database or connection.get('database')
+        self.min_size = kwargs.get('min_size', 1)
+        self.max_size = kwargs.get('max_size', 8)
+        self.idle_timeout = kwargs.get('idle_timeout', 300)
+        self.timeout = kwargs.get('timeout')
+
+        self.size = 0
+        self.closed = False
+        self._idle = deque()
+        self._cond = threading.Condition()
+
+        for _ in range(self.min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self.size += 1
+        lg.info(f'pool:Created ({self.min_size}-{self.max_size} connections to {self.database})')
+
+    def _connect(self):
+        info = self.info
+        return connect(
+            host=info['host'], port=info['port'],
+            user=info['user'], passwd=info['password'], charset=info.get('charset'),
+            database=self.database, local_infile=info.get('local_infile', False), autocommit=True)
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = []
+        while self._idle and self.size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self.size -= 1
+        return expired
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as err:
+            lg.error(f'pool:close:{str(err)}')
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise InterfaceError('pool is closed')
+
+                expired = self._expire()
+                if self._idle:
+                    conn = self._idle.pop()[0]
+                    break
+                elif self.size < self.max_size:
+                    conn = None
+                    self.size += 1
+                    break
+
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    lg.error(f'pool:acquire:No connection free after {self.timeout}s')
+                    raise TimeoutError(f'no connection free after {self.timeout}s')
+                self._cond.wait(remaining)
+
+        for item in expired:
+            self._close(item)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            else:
+                conn.ping(reconnect=True)
+            return conn
+        except Exception as err:
+            lg.error(f'pool:acquire:{str(err)}')
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, broken=False):
+        with self._cond:
+            if broken or self.closed:
+                self.size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+
+        if conn is not None:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (InterfaceError, OperationalError):
+            broken = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    @contextmanager
+    def cursor(self, cursor=None):
+        with self.connection() as conn:
+            with conn.cursor(cursor) as cur:
+                yield cur
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            idle, self._idle = self._idle, deque()
+            self.size -= len(idle)
+            self._cond.notify_all()
+
+        for conn, _ in idle:
+            self._close(conn)
+        lg.info(f'pool:Closed ({self.database})')
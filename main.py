@@ -207,6 +207,23 @@ class App:
                     ))
 
     def update_country_zone(self):
+        def transform(row):
+            if row[int(zone.type)].lower() in reject:
+                return
+
+            row = [value.replace('?', '').replace('\n', ' ') for value in row]
+            country_id = countries.get(row[int(zone.country_code2)])
+            if country_id is None:
+                return
+
+            return (
+                country_id,
+                row[int(zone.code)],
+                row[int(zone.name)],
+                row[int(zone.type)],
+                None,
+            )
+
         reject = [
             'parish', 'dependency', 'department', 'federal district', 'autonomous district', 'island council',
             'autonomous region', 'special administrative region', 'special municipality', 'administration',
@@ -218,61 +235,47 @@ class App:
         zone = IntEnum('Zone', 'country_code2 code name type population', start=0)
         files = list(_path.joinpath('csv').glob('*SubdivisionCodes.csv'))
         if files:
+            countries = {}
+            if self.db.execute('SELECT code2, id FROM country;'):
+                countries = dict(self.db.fetchall())
+
             filename = str(files[0].resolve())
-            with open(filename, errors='ignore') as f:
-                results = reader(f, delimiter=',', quotechar='"')
+            return self.db.load_csv(
+                'country_zone', filename, ('country_id', 'code', 'name', 'type', 'population'), (transform,),
+                errors='ignore', ignore=True)
 
-                for idx, row in enumerate(results):
-                    if row[3].lower() in reject:
-                        continue
+    def update_country_place(self):
+        def transform(row):
+            zone_id = zones.get((row[int(place.country_code2)], row[int(place.zone_code)]))
+            if not zone_id:
+                return
+
+            return (
+                zone_id,
+                row[int(place.code)],
+                row[int(place.name)],
+                None,
+                None,
+                row[int(place.flags)],
+                row[int(place.coordinates)],
+            )
 
-                    for column, value in enumerate(row):
-                        j = value.replace('?', '').replace('\n', ' ')
-                        row[column] = j
-
-                    sql = 'SELECT id FROM country WHERE country.code2=%s;'
-                    if self.db.execute(sql, (row[0],)):
-                        _id = self.db.fetchone()[0]
-                        self.db.insert_row('country_zone', (
-                            _id,
-                            row[int(zone.code)],
-                            row[int(zone.name)],
-                            row[int(zone.type)],
-                            None,
-                        ))
+        place = IntEnum(
+            'Place', '_changed country_code2 code _name name zone_code flags _2 _3 _4 coordinates', start=0)
 
-    def update_country_place(self):
+        zones = {}
+        sql = 'SELECT country.code2, country_zone.code, country_zone.id ' \
+              'FROM country_zone ' \
+              'JOIN country ON country.id = country_zone.country_id;'
+        if self.db.execute(sql):
+            zones = {(code2, code): _id for code2, code, _id in self.db.fetchall()}
+
+        count = 0
+        columns = ('zone_id', 'code', 'name', 'type', 'population', 'flags', 'coordinates')
         for file in self.get_unlocode_files():
             file = _path.joinpath('src', file).resolve()
-            with open(str(file), errors='ignore') as f:
-                results = reader(f, delimiter=',', quotechar='"')
-                for i, row in enumerate(results):
-
-                    place = IntEnum(
-                        'Place', '_changed country_code2 code _name name zone_code flags _2 _3 _4 coordinates',
-                        start=0)
-
-                    sql = 'SELECT id FROM country WHERE country.code2=%s;'
-                    if self.db.execute(sql, (row[int(place.country_code2)],)):
-                        country_id = self.db.fetchone()[0]
-                        sql = 'SELECT country_zone.id ' \
-                              'FROM country_zone ' \
-                              'WHERE country_zone.country_id=%s AND country_zone.code=%s;'
-                        if self.db.execute(sql, (country_id, row[int(place.zone_code)])):
-                            results = self.db.fetchone()
-                            zone_id = results[0] if results else None
-                            if not zone_id:
-                                continue
-
-                            self.db.insert_row('country_place', (
-                                zone_id,
-                                row[int(place.code)],
-                                row[int(place.name)],
-                                None,
-                                None,
-                                row[int(place.flags)],
-                                row[int(place.coordinates)],
-                            ))
+            count += self.db.load_csv('country_place', str(file), columns, (transform,), errors='ignore', ignore=True)
+        return count
 
     def update_country_place_info(self):
         files = sorted(list(_path.joinpath('csv').glob('*_all.csv')), reverse=True)
@@ -325,6 +328,7 @@ def main():
         'user': 'mary',
         'password': 'password',
         'database': 'countries',
+        'local_infile': True,
     })
 
     def us_census():
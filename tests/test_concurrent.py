@@ -0,0 +1,125 @@
+import os
+import sys
+import random
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from libs.dtree import DTree, Leaf, Node
+
+
+def build(**kwargs):
+    tree = DTree(**kwargs)
+    tree.populate([{'name': f'n{i}', 'children': [
+        {'name': f'c{j}', 'columns': [j]} for j in range(100)]} for i in range(100)], bulk=True)
+    return tree
+
+
+def run(threads, target):
+    errors = []
+
+    def work(seed):
+        try:
+            target(random.Random(seed), errors)
+        except Exception as err:
+            errors.append(repr(err))
+
+    workers = [threading.Thread(target=work, args=(seed, )) for seed in range(threads)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        sys.setswitchinterval(interval)
+    return errors
+
+
+class TestConcurrent(unittest.TestCase):
+    def test_readers_share_name_maps(self):
+        for _ in range(5):
+            tree = build(concurrent=True)
+
+            def read(rnd, errors):
+                paths = [f'/n{i}/c{j}' for i in range(100) for j in range(0, 100, 7)]
+                rnd.shuffle(paths)
+                for path in paths:
+                    if tree.resolve(path) is None:
+                        errors.append(path)
+
+            errors = run(8, read)
+            self.assertEqual(errors, [])
+
+    def test_readers_and_writers(self):
+        tree = build(concurrent=True)
+        movers = {}
+        for k in range(20):
+            mover = Node(name=f'm{k}', columns=[k])
+            tree.resolve(f'/n{k}').append(mover)
+            mover.append(Leaf(name='v', columns=[k]))
+            movers[mover.id] = mover.name
+
+        def work(rnd, errors):
+            for step in range(300):
+                node = tree.resolve(f'/n{rnd.randrange(100)}')
+                _id = rnd.choice(list(movers))
+                chance = rnd.random()
+                if chance < .1:
+                    with tree.writing():
+                        name = f'x{rnd.random()}'
+                        node.append(Leaf(name=name, columns=[1]))
+                        node.child(name).delete()
+                elif chance < .2:
+                    with tree.writing():
+                        item = tree.query(_id)
+                        if item.parent is not node:
+                            item.move(node)
+                elif chance < .5:
+                    item = tree.query(_id)
+                    if item is None or item.name != movers[_id]:
+                        errors.append(f'query {_id}')
+                    elif tree.query(rnd.choice(['n7', 'c1', 'n2/c3'])) is None:
+                        errors.append('query name')
+                    elif not any(found is item for found in tree.find_all(movers[_id], recursive=True)):
+                        errors.append(f'find_all {movers[_id]}')
+                else:
+                    with tree.reading():
+                        item = tree.query(_id)
+                        if tree.query(f'{item.parent.name}/{item.name}') is not item:
+                            errors.append(f'path {item.path()}')
+                        if sum(1 for child in node.walk() if child.name.startswith('c')) != 100:
+                            errors.append(node.name)
+
+        self.assertEqual(run(6, work), [])
+
+    def test_mapped_children_load_once(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'tree.bin')
+            build().save(path)
+
+            for _ in range(5):
+                mapped = DTree.open(path)
+
+                def read(rnd, errors):
+                    order = list(range(100))
+                    rnd.shuffle(order)
+                    for i in order:
+                        node = mapped.child(f'n{i}')
+                        if node is None or len(node) != 100:
+                            errors.append(f'n{i}')
+                        elif any(child is None for child in node):
+                            errors.append(f'n{i} holds None')
+                        elif node.child(f'c{rnd.randrange(100)}') is None:
+                            errors.append(f'n{i} child')
+
+                errors = run(6, read)
+                self.assertEqual(errors, [])
+                self.assertTrue(all(isinstance(node, Node) for node in mapped))
+
+
+if __name__ == '__main__':
+    unittest.main()
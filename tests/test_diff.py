@@ -0,0 +1,86 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from libs.dtree import DTree
+
+
+def build(data, **kwargs):
+    tree = DTree(**kwargs)
+    tree.populate(data, bulk=True)
+    return tree
+
+
+def shape(item):
+    return sorted(repr((child.name, child.columns, shape(child) if hasattr(child, 'append') else None))
+                  for child in item)
+
+
+class TestDiff(unittest.TestCase):
+    def round_trip(self, old, new, **kwargs):
+        tree, target = build(old, **kwargs), build(new, **kwargs)
+        edits = tree.diff(target)
+        tree.apply(edits)
+        self.assertEqual(shape(tree), shape(target))
+        self.assertEqual(tree.diff(target), [])
+        return edits
+
+    def test_same_named_siblings(self):
+        edits = self.round_trip([{'name': 'x', 'columns': [1]}, {'name': 'x', 'columns': [2]}],
+                                [{'name': 'x', 'columns': [1]}, {'name': 'x', 'columns': [5]}], unique=False)
+        self.assertEqual([(edit.op, edit.path) for edit in edits], [('set', 'x[1]')])
+
+    def test_names_with_slashes(self):
+        old = [{'name': 'Switzerland', 'children': [{'name': 'Bern', 'children': [
+            {'name': 'Biel/Bienne', 'columns': [1]},
+            {'name': 'Aarberg', 'children': [{'name': 'X', 'columns': [2]}]},
+            {'name': 'a\\', 'children': [{'name': 'b', 'columns': [3]}]},
+            {'name': 'c[1]', 'columns': [4]}]}]}]
+        new = [{'name': 'Switzerland', 'children': [{'name': 'Bern', 'children': [
+            {'name': 'Biel/Bienne', 'columns': [5]},
+            {'name': 'Aarberg', 'children': [{'name': 'X', 'columns': [2]}]},
+            {'name': 'Aarberg/X', 'columns': [6]},
+            {'name': 'a\\', 'children': [{'name': 'b', 'columns': [7]}]},
+            {'name': 'c[1]', 'columns': [8]}]}]}]
+        edits = self.round_trip(old, new)
+        self.assertIn(('set', 'Switzerland/Bern/Biel\\/Bienne'), [(edit.op, edit.path) for edit in edits])
+
+    def test_random_round_trips(self):
+        names = ['x', 'y', 'a/b', 'c\\', 'z[1]']
+
+        def rand(rnd, depth):
+            nodes = []
+            for _ in range(rnd.randint(0, 4)):
+                node = {'name': rnd.choice(names), 'columns': [rnd.randint(0, 2)]}
+                if depth and rnd.random() < .5:
+                    node['children'] = rand(rnd, depth - 1)
+                nodes.append(node)
+            return nodes
+
+        def mutate(rnd, nodes):
+            for node in list(nodes):
+                chance = rnd.random()
+                if chance < .1:
+                    nodes.remove(node)
+                elif chance < .2:
+                    node['name'] = rnd.choice(names)
+                elif chance < .3:
+                    node['columns'] = [rnd.randint(0, 2)]
+                elif 'children' in node:
+                    mutate(rnd, node['children'])
+            if rnd.random() < .3:
+                nodes.extend(rand(rnd, 1))
+
+        for seed in range(300):
+            rnd = random.Random(seed)
+            old = rand(rnd, 3)
+            new = rand(random.Random(seed), 3)
+            mutate(rnd, new)
+            self.round_trip(old, new, unique=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from libs.dtree import DTree
+
+
+def build():
+    # Countries are trees of their own made with parent=, as in main.py, so
+    # their ids start over at 1 and collide with the root's.
+    tree = DTree(unique=False, data_columns=['value'])
+    for name in ('Canada', 'France'):
+        country = DTree(parent=tree, name=name, errors='ignore')
+        country.populate([{'name': 'code', 'columns': [name[:2].upper()]},
+                          {'name': 'zones', 'children': [{'name': 'Zone', 'columns': [name]}]}])
+    return tree
+
+
+class TestQuery(unittest.TestCase):
+    def test_shared_ids_return_preorder_first(self):
+        tree = build()
+        self.assertEqual(tree.query(1).path(), '/Canada')
+        self.assertEqual(tree.query(2).path(), '/Canada/zones')
+        self.assertEqual(tree.query(3).path(), '/Canada/zones/Zone')
+        self.assertEqual(tree.get_cell(3, 1), 'Canada')
+        self.assertEqual(tree.query('France').query(1).path(), '/France/code')
+        self.assertEqual(tree.query('France/zones').query(3).path(), '/France/zones/Zone')
+        self.assertIsNone(tree.query('Canada/zones').query(1))
+
+    def test_order_puts_missing_values_last(self):
+        tree = DTree(data_columns=['pop'])
+        tree.populate([{'name': 'A', 'children': [
+            {'name': 'x', 'columns': [1]}, {'name': 'y', 'columns': [None]},
+            {'name': 'z', 'columns': [5]}, {'name': 'w', 'columns': [3]}]}])
+        for limit in (2, None):
+            found = [item.name for item in tree.select('A/*', order='pop', reverse=True, limit=limit)]
+            self.assertEqual(found, ['z', 'w', 'x', 'y'][:limit])
+            found = [item.name for item in tree.select('A/*', order='pop', limit=limit)]
+            self.assertEqual(found, ['x', 'w', 'z', 'y'][:limit])
+
+
+if __name__ == '__main__':
+    unittest.main()